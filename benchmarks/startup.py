@@ -0,0 +1,94 @@
+"""Startup-time benchmark: --help and a run where nothing is new, in a scratch copy"""
+
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from shutil import copytree, ignore_patterns
+from statistics import median
+from subprocess import DEVNULL, run
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+MODULES_PATH = Path(__file__).resolve().parent.parent.joinpath("modules")
+SCRIPT = "ods_downloader_casasito.py"
+REPORTS = [
+    {"url": "https://appcnd.enee.hn:3200/odsprd/f?p=110:4:::::p4_id:4", "name": "Predespacho Final"},
+    {"url": "https://appcnd.enee.hn:3200/odsprd/f?p=110:4:::::p4_id:5", "name": "Predespacho Semanal"},
+]
+# A run that finds nothing new should be over well before this
+TARGET_MS = 200
+
+
+def seed(copy_path: Path) -> None:
+    """
+    Fills the listing cache and the state store so that the newest
+    document of every report is already known; no request is needed.
+    """
+    sys.path.insert(0, str(copy_path))
+    from ods_cache import ListingCache
+    from ods_http import PROBE_ROWS
+    from ods_state import StateStore
+
+    state_folder_path = copy_path.joinpath(".runtime")
+    cache = ListingCache(folder_path=state_folder_path.joinpath("listing-cache"))
+    state = StateStore(file_path=state_folder_path.joinpath("state.db"))
+    # The first clean-up of a new store sweeps the folder; do it here, not in a timed run
+    state.is_new = False
+    for report in REPORTS:
+        document = {
+            "name": f"{report['name']} 01.01.2025",
+            "url": f"{report['url']}&download=1",
+            "k1": f"{report['name']}-1",
+            "size": 1024,
+            "published": "2025-01-01",
+        }
+        cache.put(ListingCache.key_for(report, max_rows=PROBE_ROWS), [document])
+        state.record_listing(report=report["name"], document=document)
+        attempt_id, _ = state.start_attempt(report=report["name"], document=document, file_path=copy_path.joinpath("seed.xlsx"))
+        state.finish_attempt(attempt_id=attempt_id, outcome="complete", file_path=copy_path.joinpath("seed.xlsx"), size=1024, sha256="0" * 64)
+    state.close()
+
+
+def time_runs(copy_path: Path, arguments: list[str], runs: int, expect: str = "") -> list[float]:
+    """
+    Wall-clock milliseconds of each run; expect must appear in its output,
+    so a run that took another path is not mistaken for a fast one.
+    """
+    timings = []
+    for _ in range(runs):
+        tic = perf_counter()
+        # The scripts exit through exit("Exiting."), so the status is not a failure signal
+        result = run([sys.executable, SCRIPT, *arguments], cwd=copy_path, stdin=DEVNULL, capture_output=True, text=True)
+        timings.append((perf_counter() - tic) * 1000)
+        if expect not in result.stdout + result.stderr:
+            raise RuntimeError(f"{' '.join(arguments)} did not report '{expect}':\n{result.stderr}")
+    return timings
+
+
+def main() -> int:
+    parser = ArgumentParser(description="Times cold starts of the downloader.")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as temp_path:
+        copy_path = Path(temp_path).joinpath("modules")
+        copytree(MODULES_PATH, copy_path, ignore=ignore_patterns("__pycache__", ".runtime", "backup", "*.xlsx"))
+        # Byte-compile first so the timings are not dominated by the first run
+        run([sys.executable, "-m", "compileall", "-q", str(copy_path)], check=True)
+        seed(copy_path)
+
+        results = {
+            "--help": time_runs(copy_path, ["--help"], runs=args.runs),
+            "nothing new (http)": time_runs(copy_path, ["-e", "http", "--cache-ttl", "3600"], runs=args.runs, expect="nothing new"),
+        }
+
+    for name, timings in results.items():
+        print(f"{name:<20} median {median(timings):6.1f} ms   min {min(timings):6.1f} ms   max {max(timings):6.1f} ms")
+
+    is_met = median(results["nothing new (http)"]) < TARGET_MS
+    print(f"Target {TARGET_MS} ms: {'met' if is_met else 'missed'}")
+    return 0 if is_met else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+"""Sharded historical backfill driven by the work queue"""
+
+from multiprocessing import Process
+from os import getpid
+from pathlib import Path
+from socket import gethostname
+from time import sleep
+from urllib.parse import urlsplit
+
+import ods_metrics
+import ods_notify
+from ods_http import CND, configure_sessions, download_blob, format_file_name, get_client
+from ods_log import configure as configure_logging, get_logger, shutdown as shutdown_logging
+from ods_notify import document_event
+from ods_queue import WorkQueue
+from ods_retry import Deadline, retry
+from ods_session import SessionStore
+from ods_state import StateStore
+
+
+PAGE_SIZE = 25
+
+log = get_logger("backfill")
+
+
+def seed(queue: WorkQueue, reports: list[dict]) -> None:
+    """
+    Enqueues the first listing page of every report.
+    """
+    for report in reports:
+        queue.enqueue(kind="page", key=f"page:{report['name']}:1", payload={**report, "min_row": 1})
+
+
+def process_page(queue: WorkQueue, task: dict, engines: dict[str, CND], deadline: Deadline) -> None:
+    """
+    Fans a listing page out into blob tasks and the next page.
+    """
+    payload = task["payload"]
+    report = engines.setdefault(payload["name"], CND(name=payload["name"], url=payload["url"]))
+
+    rows = retry(
+        lambda: list(report.iter_listing(min_row=payload["min_row"], max_rows=PAGE_SIZE, deadline=deadline)),
+        host=urlsplit(report.url).netloc,
+        deadline=deadline,
+        label=report.name
+        )
+    for row in rows:
+        queue.enqueue(kind="blob", key=f"blob:{report.name}:{row['k1'] or row['name']}", payload={"report": report.name, **row})
+
+    if len(rows) == PAGE_SIZE:
+        next_row = payload["min_row"] + PAGE_SIZE
+        queue.enqueue(kind="page", key=f"page:{report.name}:{next_row}", payload={**payload, "min_row": next_row})
+
+
+def download_document(
+        report: str,
+        document: dict,
+        state: StateStore,
+        destination_path: Path,
+        deadline: Deadline,
+        staging_path: None | Path = None
+        ) -> bool:
+    """
+    Downloads one document unless the state store already has it.
+    Returns False when it was skipped.
+    """
+    state.record_listing(report=report, document=document)
+    if state.is_known(report=report, document=document):
+        return False
+
+    attempt_id, file_path = state.start_attempt(report=report, document=document, file_path=destination_path.joinpath(format_file_name(document)))
+    file_name = file_path.name
+    try:
+        is_downloaded, download = retry(
+            lambda: download_blob(
+                destination_path=destination_path,
+                download_url=document["url"],
+                custom_file_name=file_name,
+                deadline=deadline,
+                expected_size=document.get("size"),
+                staging_path=staging_path
+                ),
+            host=urlsplit(document["url"]).netloc,
+            deadline=deadline,
+            label=file_name
+            )
+    except Exception:
+        state.finish_attempt(attempt_id=attempt_id, outcome="failed")
+        raise
+
+    if not is_downloaded:
+        state.finish_attempt(attempt_id=attempt_id, outcome="failed")
+        raise RuntimeError(f"{file_name} was rejected by the server")
+
+    state.finish_attempt(attempt_id=attempt_id, outcome="complete", file_path=download["path"], size=download["bytes"], sha256=download["sha256"])
+    ods_notify.publish(document_event(report=report, document=document, download=download))
+    log.info("%s successfully downloaded.", file_name, extra={"report": report, "phase": "download", "bytes": download["bytes"]})
+    return True
+
+
+def process_blob(task: dict, state: StateStore, destination_path: Path, staging_path: Path, deadline: Deadline) -> None:
+    document = task["payload"]
+    download_document(report=document["report"], document=document, state=state, destination_path=destination_path, deadline=deadline, staging_path=staging_path)
+
+
+def work(queue_path: Path, state_path: Path, destination_path: Path, deadline_seconds: float, visibility_timeout: float = 300, http2: bool = False) -> None:
+    """
+    Worker loop: lease, process, complete, until the queue is drained.
+    """
+    owner = f"{gethostname()}:{getpid()}"
+    get_client(http2=http2)
+    queue = WorkQueue(file_path=queue_path)
+    state = StateStore(file_path=state_path)
+    ods_notify.configure(folder_path=state_path.parent.joinpath("events"))
+    configure_sessions(SessionStore(folder_path=state_path.parent.joinpath("sessions")))
+    deadline = Deadline(seconds=deadline_seconds)
+    engines: dict[str, CND] = {}
+
+    try:
+        while not deadline.expired():
+            task = queue.lease(owner=owner, visibility_timeout=visibility_timeout)
+            if task is None:
+                # Leased pages elsewhere may still fan out into new tasks
+                if queue.is_drained():
+                    break
+                sleep(1)
+                continue
+
+            try:
+                with queue.keep_leased(key=task["key"], owner=owner, visibility_timeout=visibility_timeout):
+                    if task["kind"] == "page":
+                        process_page(queue=queue, task=task, engines=engines, deadline=deadline)
+                    else:
+                        process_blob(task=task, state=state, destination_path=destination_path, staging_path=state_path.parent.joinpath("staging"), deadline=deadline)
+            except Exception as e:
+                log.warning("[%s] %s failed (%s: %s).", owner, task["key"], type(e).__name__, e)
+                queue.release(key=task["key"], owner=owner, error=f"{type(e).__name__}: {e}")
+            else:
+                queue.complete(key=task["key"], owner=owner)
+    finally:
+        queue.close()
+        state.close()
+
+
+def work_process(log_level: str, is_log_json: bool, metrics_path: None | Path = None, **kwargs) -> None:
+    """
+    Worker process entry: its own log listener, flushed before the process
+    ends, and its own metrics in <metrics_path>.<pid>.
+    """
+    configure_logging(level=log_level, is_json=is_log_json)
+    # Sources inherited from the parent would report on its state, not this worker's
+    ods_metrics.clear()
+    try:
+        work(**kwargs)
+    finally:
+        if metrics_path is not None:
+            ods_metrics.dump(file_path=metrics_path.with_name(f"{metrics_path.name}.{getpid()}"))
+        shutdown_logging()
+
+
+def run_workers(workers: int, log_level: str = "INFO", is_log_json: bool = False, metrics_path: None | Path = None, **kwargs) -> None:
+    """
+    Runs workers in separate processes, or inline for a single worker, whose
+    metrics are then part of the caller's.
+    """
+    if workers <= 1:
+        work(**kwargs)
+        return
+
+    processes = [
+        Process(target=work_process, kwargs={"log_level": log_level, "is_log_json": is_log_json, "metrics_path": metrics_path, **kwargs})
+        for _ in range(workers)
+        ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
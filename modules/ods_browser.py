@@ -0,0 +1,341 @@
+"""Selenium browser engine, only imported when the browser engine is selected"""
+
+from pathlib import Path
+from shutil import rmtree
+from sys import exit
+from tempfile import mkdtemp
+from time import monotonic, perf_counter, sleep
+
+from ods_integrity import IntegrityError, WorkbookValidator
+from ods_listing import parse_rows
+from ods_log import get_logger
+from ods_profile import phase
+from ods_retry import Deadline, DeadlineExceeded, RetryableError, step
+
+try:
+    from selenium import webdriver
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.chrome.options import Options as ChromeOptions
+    from selenium.webdriver.support.wait import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+except (ImportError, ModuleNotFoundError):
+    print("\nModules are not installed!")
+    exit("Run 'pip install requirements.txt' in the terminal to fix errors.")
+
+# Optional: without psutil the process tree is read from /proc where there is one
+try:
+    import psutil
+except (ImportError, ModuleNotFoundError):
+    psutil = None
+
+PROC_PATH = Path("/proc")
+# Chrome's name for a download that is still being written
+PARTIAL_SUFFIX = ".crdownload"
+# Seconds a browser download may go without growing before it is retried
+STALL_SECONDS = 30
+HASH_CHUNK_SIZE = 1024 * 1024
+
+log = get_logger("browser")
+
+
+@phase("browser_start")
+def launch_chrome(timeout: int = 30, profile_path: None | Path = None) -> tuple[webdriver.Chrome, WebDriverWait]:
+    """
+    Starts a headless, image-less Chrome session. With profile_path its
+    cookies outlive the run; without it the session is incognito.
+    """
+    tic = perf_counter()
+    options = ChromeOptions()
+    if profile_path is None:
+        options.add_argument("--incognito")
+    else:
+        options.add_argument(f"--user-data-dir={profile_path}")
+    options.add_argument("--headless")
+    options.add_argument("--blink-settings=imagesEnabled=false")
+    driver = webdriver.Chrome(options=options)
+    wait = WebDriverWait(driver, timeout=timeout)
+    log.info("Browser opening time: %d seconds", perf_counter() - tic, extra={"phase": "browser_start", "duration_ms": round((perf_counter() - tic) * 1000)})
+    return driver, wait
+
+
+# One round trip per poll: the table body once the page shows its table, else null
+READY_SCRIPT = """
+if (document.title !== "Listado website") return null;
+if (!document.querySelector("div.t-fht-wrapper") || !document.querySelector("div#stickyTableHeader_1")) return null;
+const body = document.querySelector("div.t-fht-tbody");
+return body ? body.innerHTML : null;
+"""
+
+
+@phase("navigation")
+def latest_documents(driver, reports: list[dict], deadline: Deadline, poll_interval: float = 0.25) -> tuple[dict[str, None | dict], list[dict]]:
+    """
+    Loads every report in its own tab of the same session and reads the
+    newest row of each as soon as its table is ready. Reports that are
+    not ready within the ready step budget are left out of the result.
+    Also returns the session cookies, read while a report tab is current:
+    the tabs are closed by the time the caller downloads anything.
+    """
+    tic = perf_counter()
+    original_handle = driver.current_window_handle
+    known_handles = set(driver.window_handles)
+    opened_handles: list[str] = []
+    pending: dict[str, dict] = {}
+    with deadline.step("navigate"):
+        for report in reports:
+            # window.open returns at once, so all navigations run side by side
+            driver.execute_script("window.open(arguments[0], '_blank');", report["url"])
+            handle = next(handle for handle in driver.window_handles if handle not in known_handles)
+            known_handles.add(handle)
+            opened_handles.append(handle)
+            pending[handle] = report
+
+    documents: dict[str, None | dict] = {}
+    cookies: dict[tuple, dict] = {}
+    try:
+        with deadline.step("ready") as timeout:
+            while pending and perf_counter() - tic < timeout:
+                for handle, report in list(pending.items()):
+                    driver.switch_to.window(handle)
+                    with phase("extraction"):
+                        table_body = driver.execute_script(READY_SCRIPT)
+                    if table_body is None:
+                        continue
+                    rows = parse_rows(table_body, base_url=driver.current_url, limit=1)
+                    documents[report["url"]] = rows[0] if rows else None
+                    cookies.update(((cookie["name"], cookie.get("domain"), cookie.get("path")), cookie) for cookie in driver.get_cookies())
+                    log.info("%s ready after %.1f seconds", report["name"], perf_counter() - tic, extra={"report": report["name"], "phase": "navigation", "duration_ms": round((perf_counter() - tic) * 1000)})
+                    del pending[handle]
+                if pending:
+                    sleep(poll_interval)
+    finally:
+        for handle in opened_handles:
+            driver.switch_to.window(handle)
+            driver.close()
+        driver.switch_to.window(original_handle)
+
+    for report in pending.values():
+        log.warning("%s not ready within %.0f seconds.", report["name"], timeout, extra={"report": report["name"], "phase": "navigation"})
+    return documents, list(cookies.values())
+
+
+@phase("navigation")
+def latest_document(driver, file_url: str, deadline: Deadline) -> None | dict:
+    """
+    Navigates to the report and reads its newest row, each step within its budget.
+    """
+    tic_dl = perf_counter()
+    with deadline.step("navigate") as timeout:
+        driver.set_page_load_timeout(timeout)
+        driver.get(file_url)
+
+    with deadline.step("ready") as timeout:
+        # One wait for the whole page, so the conditions share a single budget
+        WebDriverWait(driver, timeout=timeout).until(EC.all_of(
+            EC.title_is("Listado website"),
+            EC.element_to_be_clickable((By.XPATH, '//div[@class="t-fht-wrapper"]')), # Table wrapper
+            EC.element_to_be_clickable((By.XPATH, '//div[@id="stickyTableHeader_1"]')), # Table head
+            EC.element_to_be_clickable((By.XPATH, '//div[@class="t-fht-tbody"]')), # Table body
+            ))
+    log.info("URL load time: %d seconds", perf_counter() - tic_dl, extra={"phase": "navigation", "duration_ms": round((perf_counter() - tic_dl) * 1000)})
+
+    # One round trip for the whole table body instead of one per row and cell
+    with deadline.step("extract"), phase("extraction"):
+        table_body = driver.find_element(By.XPATH, '//div[@class="t-fht-tbody"]').get_attribute("innerHTML")
+        rows = parse_rows(table_body, base_url=driver.current_url, limit=1)
+    return rows[0] if rows else None
+
+
+DOWNLOAD_SCRIPT = """
+const link = document.createElement("a");
+link.href = arguments[0];
+link.download = arguments[1];
+document.body.appendChild(link);
+link.click();
+link.remove();
+"""
+
+
+@phase("download")
+def download_in_browser(
+        driver,
+        staging_path: Path,
+        destination_path: Path,
+        download_url: str,
+        custom_file_name: str,
+        deadline: None | Deadline = None,
+        expected_size: None | int = None,
+        poll_interval: float = 0.25
+        ) -> tuple[bool, None | dict]:
+    """
+    Downloads a blob through the connected browser itself, reusing its
+    connection and session. CDP steers the file into a folder of its own
+    under staging_path; it is moved into destination_path once Chrome has
+    finished writing it and it checks out as a complete workbook. Same
+    result as ods_http.download_blob.
+    """
+    staging_path.mkdir(parents=True, exist_ok=True)
+    download_path = Path(mkdtemp(prefix=f"{custom_file_name}.", suffix=".download", dir=staging_path))
+    try:
+        # Headless Chrome refuses downloads until a behavior is set
+        driver.execute_cdp_cmd("Browser.setDownloadBehavior", {"behavior": "allow", "downloadPath": str(download_path.resolve())})
+
+        with step(deadline, "download") as timeout:
+            tic = monotonic()
+            driver.execute_script(DOWNLOAD_SCRIPT, download_url, custom_file_name)
+            size, progressed_at = -1, tic
+            while True:
+                files = [path for path in download_path.iterdir() if path.is_file()]
+                finished = [path for path in files if not path.name.endswith(PARTIAL_SUFFIX)]
+                if finished and len(files) == len(finished):
+                    break
+
+                current_size = sum(path.stat().st_size for path in files)
+                if current_size != size:
+                    size, progressed_at = current_size, monotonic()
+                    log.debug("%s: %d bytes", custom_file_name, size, extra={"phase": "download", "bytes": size})
+                elif monotonic() - progressed_at > STALL_SECONDS:
+                    raise RetryableError(f"browser download stalled at {size} bytes" if files else "browser download did not start")
+                if timeout is not None and monotonic() - tic > timeout:
+                    raise DeadlineExceeded(f"download budget of {timeout:.0f}s exhausted after {max(size, 0)} bytes")
+                sleep(poll_interval)
+
+        # Chrome names the file after the server's Content-Disposition
+        validator = WorkbookValidator(expected_size=expected_size)
+        try:
+            with open(finished[0], "rb") as file:
+                while chunk := file.read(HASH_CHUNK_SIZE):
+                    validator.update(chunk)
+            digest = validator.finish(finished[0])
+        except IntegrityError as e:
+            log.warning("%s rejected: %s", custom_file_name, e, extra={"phase": "download", "bytes": validator.size})
+            raise
+        file_path = finished[0].replace(destination_path.joinpath(custom_file_name))
+    finally:
+        rmtree(download_path, ignore_errors=True)
+
+    log.debug("%s written by the browser in %.1f seconds", custom_file_name, monotonic() - tic, extra={"phase": "download", "bytes": validator.size})
+    return True, {"path": file_path, "bytes": validator.size, "sha256": digest}
+
+
+def process_tree(root_pid: int) -> list[tuple[int, bool]]:
+    """
+    (pid, is_renderer) for root_pid and all of its descendants.
+    """
+    if psutil is not None:
+        try:
+            root = psutil.Process(root_pid)
+            processes = [root, *root.children(recursive=True)]
+        except psutil.Error:
+            return []
+        tree = []
+        for process in processes:
+            try:
+                tree.append((process.pid, "--type=renderer" in process.cmdline()))
+            except psutil.Error:
+                continue
+        return tree
+
+    if not PROC_PATH.is_dir():
+        return []
+
+    children: dict[int, list[int]] = {}
+    for entry in PROC_PATH.iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            # The command name may hold spaces and parentheses; ppid follows the last ')'
+            ppid = int(entry.joinpath("stat").read_text().rpartition(")")[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry.name))
+
+    tree = []
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        try:
+            cmdline = PROC_PATH.joinpath(str(pid), "cmdline").read_bytes()
+        except OSError:
+            continue
+        tree.append((pid, b"--type=renderer" in cmdline))
+        stack.extend(children.get(pid, []))
+    return tree
+
+
+def resident_bytes(pid: int) -> int:
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).memory_info().rss
+        except psutil.Error:
+            return 0
+    try:
+        for line in PROC_PATH.joinpath(str(pid), "status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+class BrowserMonitor:
+    """
+    Tracks the resident memory of a browser's process tree and its
+    navigation count, and tells when the browser is due for recycling.
+    A threshold of 0 disables that check.
+    """
+    def __init__(self, root_pid: int, max_navigations: int = 200, max_rss_mb: float = 1024) -> None:
+        self.root_pid = root_pid
+        self.max_navigations = max_navigations
+        self.max_rss_mb = max_rss_mb
+        self.navigations = 0
+        self.recycles = 0
+        self.peak_rss_mb = 0.0
+
+
+    def navigated(self, count: int = 1) -> None:
+        self.navigations += count
+
+
+    def memory(self) -> dict:
+        browser = renderer = 0
+        tree = process_tree(self.root_pid)
+        for pid, is_renderer in tree:
+            if is_renderer:
+                renderer += resident_bytes(pid)
+            else:
+                browser += resident_bytes(pid)
+        memory = {
+            "processes": len(tree),
+            "browser_rss_mb": round(browser / 2**20, 1),
+            "renderer_rss_mb": round(renderer / 2**20, 1),
+        }
+        self.peak_rss_mb = max(self.peak_rss_mb, memory["browser_rss_mb"] + memory["renderer_rss_mb"])
+        return memory
+
+
+    def should_recycle(self) -> bool:
+        if self.max_navigations and self.navigations >= self.max_navigations:
+            return True
+        if self.max_rss_mb:
+            memory = self.memory()
+            return memory["browser_rss_mb"] + memory["renderer_rss_mb"] >= self.max_rss_mb
+        return False
+
+
+    def reset(self, root_pid: int) -> None:
+        """
+        Starts tracking a freshly launched browser.
+        """
+        self.root_pid = root_pid
+        self.navigations = 0
+        self.recycles += 1
+
+
+    def snapshot(self) -> dict:
+        return {
+            **self.memory(),
+            "navigations": self.navigations,
+            "recycles": self.recycles,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
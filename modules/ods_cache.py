@@ -0,0 +1,66 @@
+"""Short-lived on-disk listing cache shared by concurrent invocations"""
+
+from hashlib import sha1
+from json import dumps, loads
+from os import getpid
+from pathlib import Path
+from time import time
+from typing import Callable
+from urllib.parse import urlsplit
+
+from ods_lock import file_lock
+
+
+class ListingCache:
+    """
+    Stores parsed rows per report and host for ttl seconds. Misses are
+    single-flight: one process fetches while the others wait on its lock
+    and then read what it wrote.
+    """
+    def __init__(self, folder_path: Path, ttl: float = 60) -> None:
+        folder_path.mkdir(parents=True, exist_ok=True)
+        self.folder_path = folder_path
+        self.ttl = ttl
+
+
+    @staticmethod
+    def key_for(report: dict, max_rows: int) -> str:
+        return f"{urlsplit(report['url']).netloc}|{report['name']}|{report['url']}|{max_rows}"
+
+
+    def entry_path(self, key: str) -> Path:
+        return self.folder_path.joinpath(f"{sha1(key.encode()).hexdigest()}.json")
+
+
+    def get(self, key: str) -> None | list[dict]:
+        entry_path = self.entry_path(key)
+        try:
+            if time() - entry_path.stat().st_mtime > self.ttl:
+                return None
+            return loads(entry_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def put(self, key: str, rows: list[dict]) -> None:
+        entry_path = self.entry_path(key)
+        temp_entry_path = entry_path.with_name(f"{entry_path.name}.{getpid()}.tmp")
+        temp_entry_path.write_text(dumps(rows, ensure_ascii=False))
+        temp_entry_path.replace(entry_path)
+
+
+    def get_or_fetch(self, key: str, fetch: Callable[[], list[dict]]) -> list[dict]:
+        """
+        Returns fresh cached rows, or fetches them once across all processes.
+        """
+        rows = self.get(key)
+        if rows is not None:
+            return rows
+
+        with file_lock(self.entry_path(key).with_suffix(".lock")):
+            # Whoever held the lock before us may have just filled the entry
+            rows = self.get(key)
+            if rows is None:
+                rows = fetch()
+                self.put(key, rows)
+        return rows
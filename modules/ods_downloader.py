@@ -2,7 +2,6 @@
 
 # CUSTOM MODULES
 from base import clear
-from automateLite import EC, By, generate_puppies, initialize_chrome_session, downloader
 
 
 # ### REMOVE ###
@@ -15,10 +14,13 @@ from automateLite import EC, By, generate_puppies, initialize_chrome_session, do
 # from traceback import print_exc
 # ### REMOVE ###
 
-from time import sleep
+from time import sleep, strftime
 from pathlib import Path
 from sys import exit, platform
 from argparse import ArgumentParser
+from atexit import register
+from datetime import date
+from urllib.parse import urlsplit
 
 
 parser = ArgumentParser(
@@ -30,6 +32,29 @@ parser = ArgumentParser(
 parser.add_argument("-p", "--port", type=int, default=9001)
 parser.add_argument("-b", "--binary", type=str, default="default")
 parser.add_argument("-m", "--mode", type=str, default="debug")
+parser.add_argument("-e", "--engine", type=str, default="browser")
+parser.add_argument("--http2", action="store_true")
+parser.add_argument("--download-engine", type=str, choices=("http", "chrome"), default="http", help="Fetch documents over HTTP, or inside the connected Chrome (browser engine only).")
+parser.add_argument("--deadline", type=float, default=600, help="Overall run deadline in seconds.")
+parser.add_argument("--list", action="store_true", help="Print the available documents as JSON lines and exit.")
+parser.add_argument("--cache-ttl", type=float, default=60, help="Seconds a fetched listing is shared with other invocations.")
+parser.add_argument("--compact", action="store_true", help="Pack closed months of backups into indexed bundles and exit.")
+parser.add_argument("--backfill", type=str, default="", help="Name of a historical backfill job to seed and work on.")
+parser.add_argument("--workers", type=int, default=1, help="Backfill worker processes on this host.")
+parser.add_argument("--from", dest="date_from", type=date.fromisoformat, default=None, help="Download every document published on or after this date (YYYY-MM-DD).")
+parser.add_argument("--to", dest="date_to", type=date.fromisoformat, default=None, help="Download every document published on or before this date (YYYY-MM-DD).")
+parser.add_argument("--recycle-navigations", type=int, default=200, help="Relaunch the browser after this many navigations (0 disables).")
+parser.add_argument("--recycle-rss", type=float, default=1024, help="Relaunch the browser once its processes use this many MB (0 disables).")
+parser.add_argument("--daemon", action="store_true", help="Keep running, polling each report around its learned publication time.")
+parser.add_argument("--when-due", action="store_true", help="For cron: exit at once unless a report is due by its learned schedule.")
+parser.add_argument("--poll-fast", type=float, default=60, help="Seconds between polls inside a publication window.")
+parser.add_argument("--poll-slow", type=float, default=3600, help="Longest wait between polls outside publication windows.")
+parser.add_argument("--serve", type=int, default=0, metavar="PORT", help="Serve stored documents and their data on this local port.")
+parser.add_argument("--on-overlap", type=str, choices=("exit", "attach"), default="exit", help="What to do when another run holds the lock.")
+parser.add_argument("--profile", action="store_true", help="Write per-phase cProfile and tracemalloc dumps to a run folder.")
+parser.add_argument("--log-level", type=str, choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO")
+parser.add_argument("--log-json", action="store_true", help="Log one JSON object per event.")
+parser.add_argument("--metrics", type=str, default="", help="Write limiter and run metrics to this JSON file.")
 args = parser.parse_args()
 
 if args.binary not in ("default", "undetected"):
@@ -38,16 +63,69 @@ if args.binary not in ("default", "undetected"):
 if args.mode not in ("debug", "release"):
     exit(f"Invalid mode '{args.mode}'.")
 
+if args.engine not in ("browser", "http"):
+    exit(f"Invalid engine '{args.engine}'.")
+
+if args.download_engine == "chrome" and args.engine != "browser":
+    exit("The chrome download engine needs the browser engine.")
+
+# Engines load after argument parsing; automateLite only when the browser is selected
+import ods_log
+import ods_metrics
+import ods_notify
+import ods_profile
+from ods_cache import ListingCache
+from ods_http import CND, PROBE_ROWS, close_client, configure_sessions, download_blob, format_file_name, get_client
+from ods_lock import RunLock
+from ods_notify import document_event
+from ods_state import StateStore
+from ods_store import clean_up, compact
+from ods_retry import Deadline, RetryableError, retry, step_snapshot
+from ods_schedule import Scheduler
+from ods_session import SessionStore
+
+ods_log.configure(level=args.log_level, is_json=args.log_json)
+log = ods_log.get_logger("run")
+
+
+@ods_profile.phase("navigation")
+def http_latest_document(file_name: str, file_url: str) -> None | dict:
+    """
+    Probes the report for its newest row over the HTTP engine, sharing
+    the answer with concurrent invocations for a short while.
+    """
+    def probe() -> list[dict]:
+        is_successful, document = CND(name=file_name, url=file_url).probe(deadline=deadline)
+        if not is_successful:
+            raise RetryableError(f"{file_name} listing unavailable")
+        return [document] if document else []
+
+    report = {"name": file_name, "url": file_url}
+    rows = listing_cache.get_or_fetch(key=ListingCache.key_for(report, max_rows=PROBE_ROWS), fetch=probe)
+    return rows[0] if rows else None
+
 
-def clean_up():
+@ods_profile.phase("browser_start")
+def launch_browser() -> tuple:
     """
-    Removes old failed downloads and backs up completed downloads.
+    Starts a Chrome session and attaches a driver to it.
     """
-    for file in temp_folder_path.iterdir():
-        if file.suffix not in (".xlsx", ".xls"):
-            file.unlink()
-        else:
-            file.rename(target=backup_folder_path.joinpath(file.name))
+    new_chrome = initialize_chrome_session(port=args.port, headless=True)
+    if not new_chrome:
+        exit()
+
+    try:
+        driver, wait, action = generate_puppies(
+            port=args.port, 
+            binary_executable_path=binary_executable_path, 
+            debug_mode=is_debug, 
+            load_images=False
+            )
+    except:
+        new_chrome.terminate()
+        new_chrome.wait()
+        exit()
+    return new_chrome, driver, wait
 
 
 def handler(file_name: str, file_url: str) -> None:
@@ -55,38 +133,83 @@ def handler(file_name: str, file_url: str) -> None:
     Downloads new predespacho documents.
     """
     try:
-        driver.get(file_url)
-        wait.until(EC.title_is("Listado website"))
-        wait.until(EC.element_to_be_clickable((By.XPATH, '//div[@class="t-fht-wrapper"]'))) # Table wrapper
-        wait.until(EC.element_to_be_clickable((By.XPATH, '//div[@id="stickyTableHeader_1"]'))) # Table head
-        wait.until(EC.element_to_be_clickable((By.XPATH, '//div[@class="t-fht-tbody"]'))) # Table body
-
-        all_table_rows = driver.find_element(By.XPATH, '//div[@class="t-fht-tbody"]').find_element(By.TAG_NAME, "tbody").find_elements(By.TAG_NAME, "tr")
-        
-        if len(all_table_rows) < 2:
-              return
-
-        top_most_row = all_table_rows[1]
-
-        document_data = top_most_row.find_elements(By.TAG_NAME, "td")
-        document_name = document_data[0].text.strip()
-        formatted_name = document_name.replace("/", "").replace(" ", "_") + ".xlsx"
-        document_download_url = document_data[1].find_element(By.TAG_NAME, "a").get_attribute("href")
-
-        print(f"\nDownloading {formatted_name}, please wait...")
-        is_downloaded = downloader(destination_path=temp_folder_path, download_url=document_download_url, custom_file_name=formatted_name)
+        host = urlsplit(file_url).netloc
+        if args.engine == "http":
+            document = retry(lambda: http_latest_document(file_name=file_name, file_url=file_url), host=host, deadline=deadline, label=file_name)
+        else:
+            if file_url in listed:
+                # Already read by the tabbed listing pass, whose tabs are closed now
+                document = listed[file_url]
+                cookies = listed_cookies
+            else:
+                document = retry(lambda: ods_browser.latest_document(driver=driver, file_url=file_url, deadline=deadline), host=host, deadline=deadline, label=file_name)
+                monitor.navigated()
+                cookies = driver.get_cookies()
+            # Blob requests ride the pooled client with the browser's session cookies
+            get_client().update_cookies(cookies)
+
+        if document is None:
+            return
+
+        state.record_listing(report=file_name, document=document)
+        if state.is_known(report=file_name, document=document):
+            log.info("%s: nothing new.", file_name, extra={"report": file_name})
+            return
+
+        formatted_name = format_file_name(document)
+
+        log.info("Downloading %s, please wait...", formatted_name, extra={"report": file_name, "phase": "download"})
+
+        attempt_id, file_path = state.start_attempt(report=file_name, document=document, file_path=temp_folder_path.joinpath(formatted_name))
+        formatted_name = file_path.name
+        try:
+            if args.download_engine == "chrome":
+                # Same connection and cookies as the listing; no second handshake
+                fetch = lambda: ods_browser.download_in_browser(
+                    driver=driver,
+                    staging_path=runtime_folder.joinpath("staging"),
+                    destination_path=temp_folder_path,
+                    download_url=document["url"],
+                    custom_file_name=formatted_name,
+                    deadline=deadline,
+                    expected_size=document["size"]
+                    )
+            else:
+                fetch = lambda: download_blob(
+                    destination_path=temp_folder_path,
+                    download_url=document["url"],
+                    custom_file_name=formatted_name,
+                    deadline=deadline,
+                    expected_size=document["size"],
+                    staging_path=runtime_folder.joinpath("staging")
+                    )
+            is_downloaded, download = retry(
+                fetch,
+                host=urlsplit(document["url"]).netloc,
+                deadline=deadline,
+                label=formatted_name
+                )
+        except Exception:
+            state.finish_attempt(attempt_id=attempt_id, outcome="failed")
+            raise
+
         if not is_downloaded:
-            print(f"{file_name} failed to download.")
+            state.finish_attempt(attempt_id=attempt_id, outcome="failed")
+            log.error("%s failed to download.", file_name, extra={"report": file_name, "phase": "download"})
         else:
-            print(f"{formatted_name} successfully downloaded.")
-    except:
-        print(f"\n{file_name} failed to download.")
+            state.finish_attempt(attempt_id=attempt_id, outcome="complete", file_path=download["path"], size=download["bytes"], sha256=download["sha256"])
+            ods_notify.publish(document_event(report=file_name, document=document, download=download))
+            log.info("%s successfully downloaded.", formatted_name, extra={"report": file_name, "phase": "download", "bytes": download["bytes"]})
+    except Exception as e:
+        log.error("%s failed to download (%s: %s).", file_name, type(e).__name__, e, extra={"report": file_name})
 
 
 
 if __name__ == "__main__":
 
-    clear()
+    # Keep stdout clean for --list consumers
+    if not args.list:
+        clear()
 
     # Core paths
     runtime_path: Path = Path(__file__).parent
@@ -119,6 +242,9 @@ if __name__ == "__main__":
     if not temp_folder_path.is_dir():
         temp_folder_path.mkdir(parents=True, exist_ok=True)
 
+    if args.profile:
+        ods_profile.configure(run_path=runtime_folder.joinpath("profiles", strftime("%Y%m%d-%H%M%S")))
+
     urlF = {
         # "url" : "https://otr.ods.org.hn:3200/odsprd/f?p=110:4:::::p4_id:4",
         "url" : "https://appcnd.enee.hn:3200/odsprd/f?p=110:4:::::p4_id:4",
@@ -131,38 +257,185 @@ if __name__ == "__main__":
         "name" : "Predespacho Semanal",
     }
 
-    # Launch the browser and get the job done
-    new_chrome = initialize_chrome_session(port=args.port, headless=True)
-    if not new_chrome:
+    get_client(http2=args.http2)
+    configure_sessions(SessionStore(folder_path=runtime_folder.joinpath("sessions")))
+    deadline = Deadline(seconds=args.deadline)
+    listing_cache = ListingCache(folder_path=runtime_folder.joinpath("listing-cache"), ttl=args.cache_ttl)
+
+    if args.list:
+        # Listing only: HTTP engine, no clean-up, no downloads
+        from ods_list import list_documents
+
+        list_documents(reports=[urlF, urlS], cache=listing_cache, deadline=deadline)
+        close_client()
         exit()
+    state = StateStore(file_path=runtime_folder.joinpath("state.db"))
+    ods_metrics.register("downloads", state.summary)
+    ods_metrics.register("steps", step_snapshot)
+    ods_notify.configure(folder_path=runtime_folder.joinpath("events"))
+
+    if args.serve:
+        # Read-only: serves what earlier runs stored, never contacts CND
+        from ods_server import serve
+
+        serve(state=state, port=args.serve)
+        close_client()
+        state.close()
+        exit("Exiting.")
 
-    try:
-        driver, wait, action = generate_puppies(
-            port=args.port, 
-            binary_executable_path=binary_executable_path, 
-            debug_mode=is_debug, 
-            load_images=False
+    if not args.backfill:
+        # Backfills coordinate through their queue; every other mode runs alone
+        run_lock = RunLock(lock_path=runtime_folder.joinpath("run.lock"), max_age=2 * args.deadline + (args.poll_slow if args.daemon else 0))
+        if not run_lock.acquire():
+            holder = run_lock.holder() or {"pid": None, "started": 0}
+            if args.on_overlap == "exit":
+                state.close()
+                exit(f"Another run (pid {holder['pid']}) is in progress. Exiting.")
+
+            log.info("Attaching to the run of pid %s...", holder["pid"])
+            holder = run_lock.wait(timeout=deadline.remaining()) or holder
+            for attempt in state.attempts_since(started=holder["started"]):
+                print(f"{attempt['name']} ({attempt['report']}): {attempt['outcome']}, {attempt['bytes'] or 0} bytes")
+            state.close()
+            exit("Exiting.")
+        register(run_lock.release)
+
+    if args.compact:
+        compact(backup_folder_path=backup_folder_path, state=state)
+        state.close()
+        exit("Exiting.")
+
+    if args.backfill:
+        # Backfills always use the HTTP engine; worker processes share the queue file
+        from ods_backfill import run_workers, seed
+        from ods_queue import WorkQueue
+
+        clean_up(state=state, temp_folder_path=temp_folder_path, backup_folder_path=backup_folder_path, remove_unknown=True)
+        queue_path = runtime_folder.joinpath(f"backfill-{args.backfill}.db")
+        queue = WorkQueue(file_path=queue_path)
+        seed(queue=queue, reports=[urlF, urlS])
+        queue.close()
+        run_workers(
+            workers=args.workers,
+            queue_path=queue_path,
+            state_path=runtime_folder.joinpath("state.db"),
+            destination_path=temp_folder_path,
+            deadline_seconds=args.deadline,
+            http2=args.http2,
+            log_level=args.log_level,
+            is_log_json=args.log_json,
+            metrics_path=Path(args.metrics) if args.metrics else None
             )
-    except:
-        new_chrome.terminate()
-        new_chrome.wait()
+        if args.metrics:
+            ods_metrics.dump(file_path=Path(args.metrics))
+        close_client()
+        state.close()
+        exit("Exiting.")
+
+    if args.date_from or args.date_to:
+        # Date ranges are resolved by paging the listing over HTTP
+        from ods_range import download_range
+
+        clean_up(state=state, temp_folder_path=temp_folder_path, backup_folder_path=backup_folder_path, remove_unknown=True)
+        download_range(
+            reports=[urlF, urlS],
+            date_from=args.date_from,
+            date_to=args.date_to,
+            state=state,
+            destination_path=temp_folder_path,
+            staging_path=runtime_folder.joinpath("staging"),
+            deadline=deadline
+            )
+        if args.metrics:
+            ods_metrics.dump(file_path=Path(args.metrics))
+        close_client()
+        state.close()
+        exit("Exiting.")
+
+    # Poll only what the learned publication schedule says is due
+    scheduler = Scheduler(state=state, fast=args.poll_fast, slow=args.poll_slow)
+    reports = scheduler.due([urlF, urlS]) if args.when_due else [urlF, urlS]
+    if not reports:
+        log.info("No report is due.")
+        close_client()
+        state.close()
         exit()
 
-    try:
-        clean_up()
-        for provider in (urlF, urlS):
+    # Launch the browser and get the job done
+    new_chrome = driver = monitor = None
+    if args.engine == "browser":
+        import ods_browser
+        from automateLite import generate_puppies, initialize_chrome_session
+
+        new_chrome, driver, wait = launch_browser()
+        monitor = ods_browser.BrowserMonitor(
+            root_pid=new_chrome.pid,
+            max_navigations=args.recycle_navigations,
+            max_rss_mb=args.recycle_rss
+            )
+        ods_metrics.register("browser", monitor.snapshot)
 
+    try:
+        while True:
+            listed: dict[str, None | dict] = {}
+            listed_cookies: list[dict] = []
+            clean_up(state=state, temp_folder_path=temp_folder_path, backup_folder_path=backup_folder_path, remove_unknown=True)
+            if driver is not None and reports:
+                try:
+                    # All reports load side by side in tabs; stragglers fall back to one by one
+                    monitor.navigated(count=len(reports))
+                    listed, listed_cookies = ods_browser.latest_documents(driver=driver, reports=reports, deadline=deadline)
+                except Exception as e:
+                    log.warning("Tabbed listing failed (%s: %s).", type(e).__name__, e, extra={"phase": "navigation"})
+            for provider in reports:
+
+                try:
+                    handler(file_name=provider["name"], file_url=provider["url"])
+                except KeyboardInterrupt:
+                    print("\nInterrupted by user!")
+                finally:
+                    # Pace browser navigations; the HTTP engine is paced by its limiter
+                    if driver is not None and provider["url"] not in listed:
+                        sleep(3)
+                    # Relaunch between jobs so a long-lived browser keeps a flat memory profile
+                    if monitor is not None and monitor.should_recycle():
+                        log.info("Recycling the browser.", extra={"phase": "browser_start"})
+                        driver.quit()
+                        new_chrome.terminate()
+                        new_chrome.wait()
+                        new_chrome, driver, wait = launch_browser()
+                        monitor.reset(root_pid=new_chrome.pid)
+                    continue
+
+            if not args.daemon:
+                break
+
+            # The expiry covers the sleep; losing the lock means another run owns temp/ now
+            if not run_lock.refresh():
+                break
+            if args.metrics:
+                ods_metrics.dump(file_path=Path(args.metrics))
+            delay = scheduler.next_delay([urlF, urlS])
+            log.info("Next poll in %d seconds.", delay)
             try:
-                handler(file_name=provider["name"], file_url=provider["url"])
+                sleep(delay)
             except KeyboardInterrupt:
                 print("\nInterrupted by user!")
-            finally:
-                sleep(3)
-                continue
+                break
+            if not run_lock.refresh():
+                break
+            deadline = Deadline(seconds=args.deadline)
+            reports = scheduler.due([urlF, urlS])
     finally:
-        driver.quit()
-        new_chrome.terminate()
-        new_chrome.wait()
+        if driver is not None:
+            driver.quit()
+        if new_chrome is not None:
+            new_chrome.terminate()
+            new_chrome.wait()
+        if args.metrics:
+            ods_metrics.dump(file_path=Path(args.metrics))
+        close_client()
+        state.close()
         exit("Exiting.")
 
 
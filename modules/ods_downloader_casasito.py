@@ -1,34 +1,84 @@
 """Module that downloads reports from ODS (HN) website"""
 
-import shlex
 from pathlib import Path
-from sys import exit, platform
-from time import perf_counter, sleep
-from subprocess import Popen, run, DEVNULL
-
-try:
-    from selenium import webdriver
-    from selenium.webdriver.common.by import By
-    from selenium.webdriver.chrome.options import Options as ChromeOptions
-    from selenium.webdriver.support.wait import WebDriverWait
-    from selenium.webdriver.support import expected_conditions as EC
-except (ImportError, ModuleNotFoundError):
-    print("\nModules are not installed!")
-    exit("Run 'pip install requirements.txt' in the terminal to fix errors.")
-
-
-def clean_up():
+from sys import exit
+from time import perf_counter, sleep, strftime
+from argparse import ArgumentParser
+from atexit import register
+from datetime import date
+from urllib.parse import urlsplit
+
+
+parser = ArgumentParser(
+    prog="ODS Downloader",
+    description="Downloads reports from the ODS (HN) website.",
+)
+
+parser.add_argument("-e", "--engine", type=str, default="browser")
+parser.add_argument("--http2", action="store_true")
+parser.add_argument("--download-engine", type=str, choices=("http", "chrome"), default="http", help="Fetch documents over HTTP, or inside the connected Chrome (browser engine only).")
+parser.add_argument("--deadline", type=float, default=600, help="Overall run deadline in seconds.")
+parser.add_argument("--list", action="store_true", help="Print the available documents as JSON lines and exit.")
+parser.add_argument("--cache-ttl", type=float, default=60, help="Seconds a fetched listing is shared with other invocations.")
+parser.add_argument("--compact", action="store_true", help="Pack closed months of backups into indexed bundles and exit.")
+parser.add_argument("--backfill", type=str, default="", help="Name of a historical backfill job to seed and work on.")
+parser.add_argument("--workers", type=int, default=1, help="Backfill worker processes on this host.")
+parser.add_argument("--from", dest="date_from", type=date.fromisoformat, default=None, help="Download every document published on or after this date (YYYY-MM-DD).")
+parser.add_argument("--to", dest="date_to", type=date.fromisoformat, default=None, help="Download every document published on or before this date (YYYY-MM-DD).")
+parser.add_argument("--recycle-navigations", type=int, default=200, help="Relaunch the browser after this many navigations (0 disables).")
+parser.add_argument("--recycle-rss", type=float, default=1024, help="Relaunch the browser once its processes use this many MB (0 disables).")
+parser.add_argument("--daemon", action="store_true", help="Keep running, polling each report around its learned publication time.")
+parser.add_argument("--when-due", action="store_true", help="For cron: exit at once unless a report is due by its learned schedule.")
+parser.add_argument("--poll-fast", type=float, default=60, help="Seconds between polls inside a publication window.")
+parser.add_argument("--poll-slow", type=float, default=3600, help="Longest wait between polls outside publication windows.")
+parser.add_argument("--serve", type=int, default=0, metavar="PORT", help="Serve stored documents and their data on this local port.")
+parser.add_argument("--on-overlap", type=str, choices=("exit", "attach"), default="exit", help="What to do when another run holds the lock.")
+parser.add_argument("--profile", action="store_true", help="Write per-phase cProfile and tracemalloc dumps to a run folder.")
+parser.add_argument("--log-level", type=str, choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO")
+parser.add_argument("--log-json", action="store_true", help="Log one JSON object per event.")
+parser.add_argument("--metrics", type=str, default="", help="Write limiter and run metrics to this JSON file.")
+args = parser.parse_args()
+
+if args.engine not in ("browser", "http"):
+    exit(f"Invalid engine '{args.engine}'.")
+
+if args.download_engine == "chrome" and args.engine != "browser":
+    exit("The chrome download engine needs the browser engine.")
+
+# Engines load after argument parsing; the browser stack only when selected
+import ods_log
+import ods_metrics
+import ods_notify
+import ods_profile
+from ods_cache import ListingCache
+from ods_http import CND, PROBE_ROWS, close_client, configure_sessions, download_blob, format_file_name, get_client
+from ods_lock import RunLock
+from ods_notify import document_event
+from ods_state import StateStore
+from ods_store import clean_up, compact
+from ods_retry import Deadline, RetryableError, retry, step_snapshot
+from ods_schedule import Scheduler
+from ods_session import SessionStore
+
+ods_log.configure(level=args.log_level, is_json=args.log_json)
+log = ods_log.get_logger("run")
+
+
+@ods_profile.phase("navigation")
+def http_latest_document(file_name: str, file_url: str) -> None | dict:
     """
-    Removes old failed downloads and backs up completed downloads.
+    Probes the report for its newest row over the HTTP engine, sharing
+    the answer with concurrent invocations for a short while.
     """
-    for file in runtime_path.iterdir():
-        file_name = file.name
-        if file.suffix == ".failed":
-            file.unlink()
-            print(f"Removed: {file_name}")
-        elif file.suffix in (".xlsx", ".xls"):
-            file.rename(target=backup_folder_path.joinpath(file_name))
-            print(f"Backed up: {file_name}")
+    def probe() -> list[dict]:
+        is_successful, document = CND(name=file_name, url=file_url).probe(deadline=deadline)
+        if not is_successful:
+            raise RetryableError(f"{file_name} listing unavailable")
+        return [document] if document else []
+
+    report = {"name": file_name, "url": file_url}
+    rows = listing_cache.get_or_fetch(key=ListingCache.key_for(report, max_rows=PROBE_ROWS), fetch=probe)
+    return rows[0] if rows else None
 
 
 def ods_downloader(file_name: str, file_url: str) -> None:
@@ -36,54 +86,75 @@ def ods_downloader(file_name: str, file_url: str) -> None:
     Downloads new predespacho documents.
     """
     try:
-        tic_dl = perf_counter()
-        driver.get(file_url)
-        wait.until(EC.title_is("Listado website"))
-        wait.until(EC.element_to_be_clickable((By.XPATH, '//div[@class="t-fht-wrapper"]'))) # Table wrapper
-        wait.until(EC.element_to_be_clickable((By.XPATH, '//div[@id="stickyTableHeader_1"]'))) # Table head
-        wait.until(EC.element_to_be_clickable((By.XPATH, '//div[@class="t-fht-tbody"]'))) # Table body
-        print(f"URL load time: {int(perf_counter() - tic_dl)} seconds")
-
-        all_table_rows = driver.find_element(By.XPATH, '//div[@class="t-fht-tbody"]').find_element(By.TAG_NAME, "tbody").find_elements(By.TAG_NAME, "tr")
-        
-        if len(all_table_rows) < 2:
-            return
+        host = urlsplit(file_url).netloc
+        if args.engine == "http":
+            document = retry(lambda: http_latest_document(file_name=file_name, file_url=file_url), host=host, deadline=deadline, label=file_name)
+        else:
+            if file_url in listed:
+                # Already read by the tabbed listing pass, whose tabs are closed now
+                document = listed[file_url]
+                cookies = listed_cookies
+            else:
+                document = retry(lambda: ods_browser.latest_document(driver=driver, file_url=file_url, deadline=deadline), host=host, deadline=deadline, label=file_name)
+                monitor.navigated()
+                cookies = driver.get_cookies()
+            # Blob requests ride the pooled client with the browser's session cookies
+            get_client().update_cookies(cookies)
 
-        top_most_row = all_table_rows[1]
+        if document is None:
+            return
 
-        document_data = top_most_row.find_elements(By.TAG_NAME, "td")
-        document_name = document_data[0].text.strip()
-        formatted_name = document_name.replace("/", "").replace(" ", "_") + ".xlsx"
-        document_download_url = document_data[1].find_element(By.TAG_NAME, "a").get_attribute("href")
+        state.record_listing(report=file_name, document=document)
+        if state.is_known(report=file_name, document=document):
+            log.info("%s: nothing new.", file_name, extra={"report": file_name})
+            return
 
-        print(f"\nDownloading {formatted_name}, please wait...")
+        formatted_name = format_file_name(document)
 
-        temp_destination_path = f"'{runtime_path}'" if platform == "win32" else runtime_path
-        download_command = f"curl --insecure --output {formatted_name} --output-dir {temp_destination_path} {document_download_url}"
+        log.info("Downloading %s, please wait...", formatted_name, extra={"report": file_name, "phase": "download"})
 
-        # Launch the curler and get the job done
+        attempt_id, file_path = state.start_attempt(report=file_name, document=document, file_path=runtime_path.joinpath(formatted_name))
+        formatted_name = file_path.name
         try:
-            with Popen(args=shlex.split(download_command), stderr=DEVNULL, shell=True if platform == "win32" else False) as curler:
-
-                is_done = curler.poll()
-                while is_done is None:
-                    sleep(1)
-                    is_done = curler.poll()
+            if args.download_engine == "chrome":
+                # Same connection and cookies as the listing; no second handshake
+                fetch = lambda: ods_browser.download_in_browser(
+                    driver=driver,
+                    staging_path=state_folder_path.joinpath("staging"),
+                    destination_path=runtime_path,
+                    download_url=document["url"],
+                    custom_file_name=formatted_name,
+                    deadline=deadline,
+                    expected_size=document["size"]
+                    )
+            else:
+                fetch = lambda: download_blob(
+                    destination_path=runtime_path,
+                    download_url=document["url"],
+                    custom_file_name=formatted_name,
+                    deadline=deadline,
+                    expected_size=document["size"],
+                    staging_path=state_folder_path.joinpath("staging")
+                    )
+            is_downloaded, download = retry(
+                fetch,
+                host=urlsplit(document["url"]).netloc,
+                deadline=deadline,
+                label=formatted_name
+                )
+        except Exception:
+            state.finish_attempt(attempt_id=attempt_id, outcome="failed")
+            raise
 
-                print(f"{formatted_name} successfully downloaded.")
-        except:
-            move_command = f"mv {runtime_path.joinpath(formatted_name)} {runtime_path.joinpath(f'{formatted_name}.failed')}"
-
-            # Rename failed downloads by appending a '.failed' suffix to their names
-            if platform == "win32": move_command = 'powershell -command ' + '"&{' + move_command + '}"'
-
-            run(args=shlex.split(move_command), stderr=DEVNULL, shell=True if platform == "win32" else False)
-            print(f"{file_name} failed to download.")
-        finally:
-            curler.terminate()
-            curler.wait()
-    except:
-        print(f"\n{file_name} failed to download.")
+        if is_downloaded:
+            state.finish_attempt(attempt_id=attempt_id, outcome="complete", file_path=download["path"], size=download["bytes"], sha256=download["sha256"])
+            ods_notify.publish(document_event(report=file_name, document=document, download=download))
+            log.info("%s successfully downloaded.", formatted_name, extra={"report": file_name, "phase": "download", "bytes": download["bytes"]})
+        else:
+            state.finish_attempt(attempt_id=attempt_id, outcome="failed")
+            log.error("%s failed to download.", file_name, extra={"report": file_name, "phase": "download"})
+    except Exception as e:
+        log.error("%s failed to download (%s: %s).", file_name, type(e).__name__, e, extra={"report": file_name})
 
 
 
@@ -91,19 +162,14 @@ if __name__ == "__main__":
 
     runtime_path: Path = Path(__file__).parent
     backup_folder_path = runtime_path.joinpath("backup")
+    state_folder_path = runtime_path.joinpath(".runtime")
 
     # Check for backup folder folder
     if not backup_folder_path.is_dir():
         backup_folder_path.mkdir(parents=True, exist_ok=True)
 
-    tic = perf_counter()
-    options = ChromeOptions()
-    options.add_argument("--incognito")
-    options.add_argument("--headless")
-    options.add_argument("--blink-settings=imagesEnabled=false")
-    driver = webdriver.Chrome(options=options)
-    wait = WebDriverWait(driver, timeout=30)
-    print(f"Browser opening time: {int(perf_counter() - tic)} seconds")
+    if args.profile:
+        ods_profile.configure(run_path=state_folder_path.joinpath("profiles", strftime("%Y%m%d-%H%M%S")))
 
     urlF = {
         "url" : "https://appcnd.enee.hn:3200/odsprd/f?p=110:4:::::p4_id:4",
@@ -115,20 +181,178 @@ if __name__ == "__main__":
         "name" : "Predespacho Semanal",
     }
 
+    get_client(http2=args.http2)
+    configure_sessions(SessionStore(folder_path=state_folder_path.joinpath("sessions")))
+    deadline = Deadline(seconds=args.deadline)
+    listing_cache = ListingCache(folder_path=state_folder_path.joinpath("listing-cache"), ttl=args.cache_ttl)
+
+    if args.list:
+        # Listing only: HTTP engine, no clean-up, no downloads
+        from ods_list import list_documents
+
+        list_documents(reports=[urlF, urlS], cache=listing_cache, deadline=deadline)
+        close_client()
+        exit()
+    state = StateStore(file_path=state_folder_path.joinpath("state.db"))
+    ods_metrics.register("downloads", state.summary)
+    ods_metrics.register("steps", step_snapshot)
+    ods_notify.configure(folder_path=state_folder_path.joinpath("events"))
+
+    if args.serve:
+        # Read-only: serves what earlier runs stored, never contacts CND
+        from ods_server import serve
+
+        serve(state=state, port=args.serve)
+        close_client()
+        state.close()
+        exit("Exiting.")
+
+    if not args.backfill:
+        # Backfills coordinate through their queue; every other mode runs alone
+        run_lock = RunLock(lock_path=state_folder_path.joinpath("run.lock"), max_age=2 * args.deadline + (args.poll_slow if args.daemon else 0))
+        if not run_lock.acquire():
+            holder = run_lock.holder() or {"pid": None, "started": 0}
+            if args.on_overlap == "exit":
+                state.close()
+                exit(f"Another run (pid {holder['pid']}) is in progress. Exiting.")
+
+            log.info("Attaching to the run of pid %s...", holder["pid"])
+            holder = run_lock.wait(timeout=deadline.remaining()) or holder
+            for attempt in state.attempts_since(started=holder["started"]):
+                print(f"{attempt['name']} ({attempt['report']}): {attempt['outcome']}, {attempt['bytes'] or 0} bytes")
+            state.close()
+            exit("Exiting.")
+        register(run_lock.release)
+
+    if args.compact:
+        compact(backup_folder_path=backup_folder_path, state=state)
+        state.close()
+        exit("Exiting.")
+
+    if args.backfill:
+        # Backfills always use the HTTP engine; worker processes share the queue file
+        from ods_backfill import run_workers, seed
+        from ods_queue import WorkQueue
+
+        clean_up(state=state, temp_folder_path=runtime_path, backup_folder_path=backup_folder_path)
+        queue_path = state_folder_path.joinpath(f"backfill-{args.backfill}.db")
+        queue = WorkQueue(file_path=queue_path)
+        seed(queue=queue, reports=[urlF, urlS])
+        queue.close()
+        run_workers(
+            workers=args.workers,
+            queue_path=queue_path,
+            state_path=state_folder_path.joinpath("state.db"),
+            destination_path=runtime_path,
+            deadline_seconds=args.deadline,
+            http2=args.http2,
+            log_level=args.log_level,
+            is_log_json=args.log_json,
+            metrics_path=Path(args.metrics) if args.metrics else None
+            )
+        if args.metrics:
+            ods_metrics.dump(file_path=Path(args.metrics))
+        close_client()
+        state.close()
+        exit("Exiting.")
+
+    if args.date_from or args.date_to:
+        # Date ranges are resolved by paging the listing over HTTP
+        from ods_range import download_range
+
+        clean_up(state=state, temp_folder_path=runtime_path, backup_folder_path=backup_folder_path)
+        download_range(
+            reports=[urlF, urlS],
+            date_from=args.date_from,
+            date_to=args.date_to,
+            state=state,
+            destination_path=runtime_path,
+            staging_path=state_folder_path.joinpath("staging"),
+            deadline=deadline
+            )
+        if args.metrics:
+            ods_metrics.dump(file_path=Path(args.metrics))
+        close_client()
+        state.close()
+        exit("Exiting.")
+
+    # Poll only what the learned publication schedule says is due
+    scheduler = Scheduler(state=state, fast=args.poll_fast, slow=args.poll_slow)
+    reports = scheduler.due([urlF, urlS]) if args.when_due else [urlF, urlS]
+    if not reports:
+        log.info("No report is due.")
+        close_client()
+        state.close()
+        exit()
+
+    driver = monitor = None
+    if args.engine == "browser":
+        import ods_browser
+        driver, wait = ods_browser.launch_chrome(profile_path=state_folder_path.joinpath("chrome-profile"))
+        monitor = ods_browser.BrowserMonitor(
+            root_pid=driver.service.process.pid,
+            max_navigations=args.recycle_navigations,
+            max_rss_mb=args.recycle_rss
+            )
+        ods_metrics.register("browser", monitor.snapshot)
+
     try:
-        clean_up()
-        for i in (urlF, urlS):
+        while True:
+            listed: dict[str, None | dict] = {}
+            listed_cookies: list[dict] = []
+            clean_up(state=state, temp_folder_path=runtime_path, backup_folder_path=backup_folder_path)
+            if driver is not None and reports:
+                try:
+                    # All reports load side by side in tabs; stragglers fall back to one by one
+                    monitor.navigated(count=len(reports))
+                    listed, listed_cookies = ods_browser.latest_documents(driver=driver, reports=reports, deadline=deadline)
+                except Exception as e:
+                    log.warning("Tabbed listing failed (%s: %s).", type(e).__name__, e, extra={"phase": "navigation"})
+            for i in reports:
+                try:
+                    tic_i = perf_counter()
+                    ods_downloader(file_name=i["name"], file_url=i["url"])
+                    log.info("Runtime for %s: %d seconds", i["name"], perf_counter() - tic_i, extra={"report": i["name"], "duration_ms": round((perf_counter() - tic_i) * 1000)})
+                except KeyboardInterrupt:
+                    print("\nInterrupted by user!")
+                finally:
+                    # Pace browser navigations; the HTTP engine is paced by its limiter
+                    if driver is not None and i["url"] not in listed:
+                        sleep(1)
+                    # Relaunch between jobs so a long-lived browser keeps a flat memory profile
+                    if monitor is not None and monitor.should_recycle():
+                        log.info("Recycling the browser.", extra={"phase": "browser_start"})
+                        driver.quit()
+                        driver, wait = ods_browser.launch_chrome(profile_path=state_folder_path.joinpath("chrome-profile"))
+                        monitor.reset(root_pid=driver.service.process.pid)
+                    continue
+
+            if not args.daemon:
+                break
+
+            # The expiry covers the sleep; losing the lock means another run owns temp/ now
+            if not run_lock.refresh():
+                break
+            if args.metrics:
+                ods_metrics.dump(file_path=Path(args.metrics))
+            delay = scheduler.next_delay([urlF, urlS])
+            log.info("Next poll in %d seconds.", delay)
             try:
-                tic_i = perf_counter()
-                ods_downloader(file_name=i["name"], file_url=i["url"])
-                print(f"Runtime for {i['name']}: {int(perf_counter() - tic_i)} seconds")
+                sleep(delay)
             except KeyboardInterrupt:
                 print("\nInterrupted by user!")
-            finally:
-                sleep(1)
-                continue
+                break
+            if not run_lock.refresh():
+                break
+            deadline = Deadline(seconds=args.deadline)
+            reports = scheduler.due([urlF, urlS])
     finally:
-        driver.quit()
+        if driver is not None:
+            driver.quit()
+        if args.metrics:
+            ods_metrics.dump(file_path=Path(args.metrics))
+        close_client()
+        state.close()
         exit("Exiting.")
 
 
@@ -0,0 +1,512 @@
+"""Shared, pooled HTTP client used by every engine to talk to the CND server"""
+
+import re
+from json import loads
+from os import close
+from pathlib import Path
+from sys import exit
+from tempfile import mkstemp
+from threading import Lock
+from time import monotonic, perf_counter
+from typing import Callable, Iterator
+from urllib.parse import urlsplit
+
+import ods_metrics
+from ods_integrity import IntegrityError, WorkbookValidator
+from ods_limiter import AIMDLimiter, is_overload_status
+from ods_listing import iter_rows
+from ods_log import get_logger
+from ods_profile import phase
+from ods_retry import Deadline, DeadlineExceeded, RetryableError, step
+from ods_session import SessionStore
+
+log = get_logger("http")
+
+CHUNK_SIZE = 64 * 1024
+
+# Smallest page the interactive report row selector offers
+PROBE_ROWS = 1
+
+# (connect, read) seconds; a hung transfer must not hold a slot forever
+DEFAULT_TIMEOUT = (10, 60)
+
+BROWSER_HEADERS = {
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'Accept-Language': 'en-GB,en-US;q=0.9,en;q=0.8',
+    'Connection': 'keep-alive',
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36',
+    'sec-ch-ua': '"Not(A:Brand";v="99", "Google Chrome";v="133", "Chromium";v="133"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"macOS"',
+}
+
+
+class HTTPClient:
+    """
+    Keep-alive connection pool shared by listings, ajax calls and blobs.
+    """
+    def __init__(self, pool_hosts: int = 4, pool_per_host: int = 8, http2: bool = False) -> None:
+        self.is_http2_requested = http2
+        self.http2 = False
+        self.httpx = None
+        self.pool_hosts = pool_hosts
+        self.pool_per_host = pool_per_host
+        self.limiters: dict[str, AIMDLimiter] = {}
+        self._limiters_lock = Lock()
+        self._session = None
+        self._session_lock = Lock()
+
+
+    @property
+    def session(self):
+        """
+        The transport, built on first use: runs answered from the listing
+        cache or the state store never import requests or httpx.
+        """
+        with self._session_lock:
+            if self._session is None:
+                self._session = self.connect()
+            return self._session
+
+
+    def connect(self):
+        if self.is_http2_requested:
+            # Optional dependency, imported only when HTTP/2 is requested
+            try:
+                import httpx
+            except (ImportError, ModuleNotFoundError):
+                log.warning("httpx is not installed, falling back to HTTP/1.1.")
+            else:
+                self.http2 = True
+                self.httpx = httpx
+                # A single multiplexed connection per host carries every request
+                return httpx.Client(
+                    http2=True,
+                    verify=False,
+                    headers=BROWSER_HEADERS,
+                    limits=httpx.Limits(max_connections=self.pool_hosts * self.pool_per_host, max_keepalive_connections=self.pool_per_host),
+                    follow_redirects=True,
+                )
+
+        try:
+            from requests import Session
+            from requests.adapters import HTTPAdapter
+            from urllib3 import disable_warnings
+            from urllib3.exceptions import InsecureRequestWarning
+        except (ImportError, ModuleNotFoundError):
+            print("\nModules are not installed!")
+            exit("Run 'pip install requirements.txt' in the terminal to fix errors.")
+
+        # The CND server presents a certificate curl could never verify either
+        disable_warnings(InsecureRequestWarning)
+
+        # Warm sockets are reused, so the TLS handshake to :3200 happens once per pooled connection
+        session = Session()
+        session.verify = False
+        session.headers.update(BROWSER_HEADERS)
+        adapter = HTTPAdapter(pool_connections=self.pool_hosts, pool_maxsize=self.pool_per_host, pool_block=True)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+
+    def limiter(self, url: str) -> AIMDLimiter:
+        """
+        Returns the concurrency limiter of the url's host.
+        """
+        host = urlsplit(url).netloc
+        with self._limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = AIMDLimiter(name=host, maximum=self.pool_per_host)
+                ods_metrics.register(f"limiter:{host}", self.limiters[host].snapshot)
+            return self.limiters[host]
+
+
+    def timeout(self, timeout: tuple[float, float]):
+        """
+        (connect, read) in the form the active transport expects.
+        """
+        if self.http2:
+            connect, read = timeout
+            return self.httpx.Timeout(read, connect=connect)
+        return timeout
+
+
+    def request(self, method: str, url: str, **kwargs):
+        """
+        Sends one request inside a limiter slot.
+        """
+        session = self.session
+        kwargs["timeout"] = self.timeout(kwargs.get("timeout", DEFAULT_TIMEOUT))
+        limiter = self.limiter(url)
+        started = limiter.acquire()
+        try:
+            response = session.request(method, url, **kwargs)
+        except Exception:
+            limiter.release(started, is_successful=False, is_overloaded=True)
+            raise
+        is_overloaded = is_overload_status(response.status_code)
+        limiter.release(started, is_successful=response.status_code < 400, is_overloaded=is_overloaded)
+        return response
+
+
+    def get(self, url: str, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+
+    def post(self, url: str, data: dict, **kwargs):
+        return self.request("POST", url, data=data, **kwargs)
+
+
+    def stream(self, url: str, method: str = "GET", **kwargs):
+        """
+        Yields (status_code, headers, chunk iterator) for a streamed request.
+        The limiter slot is held until the body has been consumed.
+        """
+        session = self.session
+        kwargs["timeout"] = self.timeout(kwargs.get("timeout", DEFAULT_TIMEOUT))
+        if self.http2:
+            return _HTTPXStream(session.stream(method, url, **kwargs), self.limiter(url))
+        return _RequestsStream(lambda: session.request(method, url, stream=True, **kwargs), self.limiter(url))
+
+
+    def update_cookies(self, cookies: list[dict]) -> None:
+        """
+        Imports cookies exported by a browser engine.
+        """
+        for cookie in cookies:
+            self.session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain", ""), path=cookie.get("path", "/"))
+
+
+    def export_cookies(self, host: str) -> list[dict]:
+        """
+        Cookies that would be sent to host, in the browser engine's format.
+        """
+        hostname = host.split(":")[0]
+        session = self.session
+        jar = session.cookies.jar if self.http2 else session.cookies
+        return [
+            {"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path, "expires": cookie.expires}
+            for cookie in jar
+            if hostname == cookie.domain.lstrip(".") or hostname.endswith("." + cookie.domain.lstrip("."))
+        ]
+
+
+    def close(self) -> None:
+        if self._session is not None:
+            self._session.close()
+
+
+class _LimitedStream:
+    def __init__(self, limiter: AIMDLimiter) -> None:
+        self.limiter = limiter
+        self.started = 0.0
+        self.latency = None
+        self.status_code = 0
+
+    def _opened(self, status_code: int) -> None:
+        # Time to headers is the health signal; body length depends on the blob
+        self.latency = perf_counter() - self.started
+        self.status_code = status_code
+
+    def _closed(self, exc_type) -> None:
+        is_successful = exc_type is None and 0 < self.status_code < 400
+        is_overloaded = exc_type is not None or is_overload_status(self.status_code)
+        self.limiter.release(self.started, is_successful=is_successful, is_overloaded=is_overloaded, latency=self.latency)
+
+
+class _RequestsStream(_LimitedStream):
+    def __init__(self, send, limiter: AIMDLimiter) -> None:
+        super().__init__(limiter)
+        self.send = send
+        self.response = None
+
+    def __enter__(self):
+        self.started = self.limiter.acquire()
+        try:
+            self.response = self.send()
+        except Exception as e:
+            self._closed(type(e))
+            raise
+        self._opened(self.response.status_code)
+        return self.response.status_code, self.response.headers, self.response.iter_content(chunk_size=CHUNK_SIZE)
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.response.close()
+        self._closed(exc_type)
+
+
+class _HTTPXStream(_LimitedStream):
+    def __init__(self, manager, limiter: AIMDLimiter) -> None:
+        super().__init__(limiter)
+        self.manager = manager
+
+    def __enter__(self):
+        self.started = self.limiter.acquire()
+        try:
+            response = self.manager.__enter__()
+        except Exception as e:
+            self._closed(type(e))
+            raise
+        self._opened(response.status_code)
+        return response.status_code, response.headers, response.iter_bytes(chunk_size=CHUNK_SIZE)
+
+    def __exit__(self, exc_type, *exc) -> None:
+        self.manager.__exit__(exc_type, *exc)
+        self._closed(exc_type)
+
+
+_client: HTTPClient | None = None
+_client_lock = Lock()
+_sessions: SessionStore | None = None
+_restored_hosts: set[str] = set()
+
+
+def get_client(**kwargs) -> HTTPClient:
+    """
+    Returns the process-wide client, creating it on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HTTPClient(**kwargs)
+        return _client
+
+
+def close_client() -> None:
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def configure_sessions(sessions: SessionStore) -> None:
+    """
+    Persists cookies and APEX page state through sessions from now on.
+    """
+    global _sessions
+    _sessions = sessions
+
+
+def request_timeout(timeout: None | float) -> tuple[float, float]:
+    """
+    (connect, read) timeouts for a step budget, or the defaults when unbudgeted.
+    """
+    if timeout is None:
+        return DEFAULT_TIMEOUT
+    return min(DEFAULT_TIMEOUT[0], timeout), timeout
+
+
+def format_file_name(document: dict) -> str:
+    """
+    File name a document is stored under.
+    """
+    return document["name"].replace("/", "").replace(" ", "_") + ".xlsx"
+
+
+@phase("download")
+def download_blob(
+        destination_path: Path,
+        download_url: str,
+        custom_file_name: str,
+        deadline: None | Deadline = None,
+        expected_size: None | int = None,
+        staging_path: None | Path = None
+        ) -> tuple[bool, None | dict]:
+    """
+    Streams a blob into staging_path over the shared pool, validating it
+    on the way, and moves it into destination_path only once it checks out
+    as a complete workbook. The whole transfer, not just each read, is
+    bounded by the download step budget.
+    """
+    staging_path = staging_path or destination_path.joinpath(".staging")
+    staging_path.mkdir(parents=True, exist_ok=True)
+    # Unique per call: range downloads run on several threads of one process
+    descriptor, staged_file_name = mkstemp(prefix=f"{custom_file_name}.", suffix=".part", dir=staging_path)
+    close(descriptor)
+    staged_file_path = Path(staged_file_name)
+    validator = WorkbookValidator(expected_size=expected_size)
+    try:
+        with step(deadline, "download") as timeout:
+            stop_at = None if timeout is None else monotonic() + timeout
+            with get_client().stream(download_url, timeout=request_timeout(timeout)) as (status_code, _, chunks):
+                if is_overload_status(status_code):
+                    raise RetryableError(f"blob returned {status_code}")
+                if status_code != 200:
+                    log.warning("Error: %s", status_code, extra={"phase": "download", "host": urlsplit(download_url).netloc})
+                    return False, None
+
+                with open(staged_file_path, "wb") as file:
+                    for chunk in chunks:
+                        validator.update(chunk)
+                        file.write(chunk)
+                        if stop_at is not None and monotonic() > stop_at:
+                            raise DeadlineExceeded(f"download budget of {timeout:.0f}s exhausted after {validator.size} bytes")
+            digest = validator.finish(staged_file_path)
+        file_path = staged_file_path.replace(destination_path.joinpath(custom_file_name))
+    except IntegrityError as e:
+        log.warning("%s rejected: %s", custom_file_name, e, extra={"phase": "download", "bytes": validator.size})
+        raise
+    finally:
+        # Refused, rejected or interrupted transfers leave nothing behind
+        staged_file_path.unlink(missing_ok=True)
+    return True, {"path": file_path, "bytes": validator.size, "sha256": digest}
+
+
+class CND:
+    """
+    HTTP listing engine for one APEX interactive report.
+    """
+    def __init__(self, name: str, url: str) -> None:
+        self.name = name
+        self.url = url
+        self.origin = "{0.scheme}://{0.netloc}".format(urlsplit(url))
+        self.host = urlsplit(url).netloc
+        self.page_state: dict[str, str] = {}
+        self.is_restored = False
+        if _sessions is not None:
+            self.restore()
+
+
+    def restore(self) -> None:
+        """
+        Picks up the session a previous run left for this report, so the
+        bootstrap navigation can be skipped.
+        """
+        session = _sessions.load(self.host)
+        if self.host not in _restored_hosts:
+            # Only once per process; afterwards the live client is newer
+            get_client().update_cookies(session["cookies"])
+            _restored_hosts.add(self.host)
+        self.page_state = session["page_states"].get(self.url, {})
+        self.is_restored = bool(self.page_state)
+
+
+    def remember(self) -> None:
+        if _sessions is not None:
+            _sessions.save(self.host, cookies=get_client().export_cookies(self.host), url=self.url, page_state=self.page_state or None)
+
+
+    def reject(self) -> None:
+        """
+        Drops a session the server no longer accepts; the next call bootstraps afresh.
+        """
+        self.page_state = {}
+        self.is_restored = False
+        self.remember()
+
+
+    def bootstrap(self, deadline: None | Deadline = None) -> bool:
+        """
+        Loads the report page and collects the APEX state needed for ajax calls.
+        """
+        with step(deadline, "navigate") as timeout:
+            response = get_client().get(self.url, timeout=request_timeout(timeout))
+        if is_overload_status(response.status_code):
+            raise RetryableError(f"report page returned {response.status_code}")
+        if response.status_code != 200:
+            log.warning("Error: %s", response.status_code, extra={"report": self.name, "host": urlsplit(self.url).netloc})
+            return False
+
+        page = response.text
+        patterns = {
+            "p_instance": r'name="p_instance" value="(\d+)"',
+            "salt": r'value="(\d+)" id="pSalt"',
+            "worksheet_id": r'_worksheet_id" value="(\d+)"',
+            "report_id": r'_report_id" value="(\d+)"',
+            "ajax_id": r'"ajaxIdentifier":"([^"]+)"',
+        }
+        state = {}
+        for key, pattern in patterns.items():
+            match = re.search(pattern, page)
+            if not match or not match.group(1):
+                log.warning("%s: missing '%s' in the report page.", self.name, key, extra={"report": self.name})
+                return False
+            state[key] = match.group(1)
+
+        state["ajax_id"] = loads(f'"{state["ajax_id"]}"')
+        self.page_state = state
+        self.is_restored = False
+        self.remember()
+        return True
+
+
+    def listing_request(self, min_row: int = 1, max_rows: int = 25) -> tuple[str, dict, dict]:
+        """
+        Builds the wwv_flow.ajax request for one page of the interactive report.
+        """
+        state = self.page_state
+        data = {
+            'p_flow_id': '110',
+            'p_flow_step_id': '4',
+            'p_instance': state["p_instance"],
+            'p_debug': '',
+            'p_request': f'PLUGIN={state["ajax_id"]}',
+            'p_widget_name': 'worksheet',
+            'p_widget_mod': 'PULL',
+            'p_widget_num_return': str(max_rows),
+            'x01': state["worksheet_id"],
+            'x02': state["report_id"],
+            'p_json': '{"pageItems":null,"salt":"%s"}' % state["salt"],
+        }
+        if min_row > 1:
+            data['p_widget_action'] = 'PAGE'
+            data['p_widget_action_mod'] = f'pgR_min_row={min_row}max_rows={max_rows}rows_fetched={max_rows}'
+
+        headers = {
+            'Accept': 'text/html, */*; q=0.01',
+            'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+            'Origin': self.origin,
+            'Referer': self.url,
+            'X-Requested-With': 'XMLHttpRequest',
+        }
+        return f'{self.origin}/odsprd/wwv_flow.ajax?p_context=110:4:{state["p_instance"]}', data, headers
+
+
+    def iter_listing(
+            self,
+            min_row: int = 1,
+            max_rows: int = 25,
+            limit: int | None = None,
+            stop: Callable[[dict], bool] | None = None,
+            deadline: None | Deadline = None
+            ) -> Iterator[dict]:
+        """
+        Streams one listing page, yielding rows as they are parsed and
+        closing the response as soon as the caller has what it wants.
+        """
+        if not self.page_state and not self.bootstrap(deadline=deadline):
+            raise RetryableError(f"{self.name} report page could not be bootstrapped")
+
+        url, data, headers = self.listing_request(min_row=min_row, max_rows=max_rows)
+        with step(deadline, "extract") as timeout:
+            with get_client().stream(url, method="POST", data=data, headers=headers, timeout=request_timeout(timeout)) as (status_code, _, chunks):
+                if status_code != 200:
+                    # A stale APEX session answers with an error; start over next time
+                    self.reject()
+                    raise RetryableError(f"wwv_flow.ajax returned {status_code}")
+
+                for row in iter_rows(chunks, base_url=f"{self.origin}/odsprd/", limit=limit, stop=stop):
+                    # Rows prove the server accepted the session
+                    self.is_restored = False
+                    yield row
+
+        if self.is_restored:
+            # An expired APEX session can still answer 200, just without rows
+            self.reject()
+            raise RetryableError(f"{self.name} restored session was rejected")
+
+
+    def probe(self, deadline: None | Deadline = None) -> tuple[bool, None | dict]:
+        """
+        Asks the report for its newest row only; the default ordering is
+        newest first, so a one-row page answers "is there anything new?"
+        """
+        if not self.page_state and not self.bootstrap(deadline=deadline):
+            return False, None
+
+        rows = list(self.iter_listing(max_rows=PROBE_ROWS, limit=1, deadline=deadline))
+        if not rows:
+            return True, None
+        return True, rows[0]
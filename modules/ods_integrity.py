@@ -0,0 +1,100 @@
+"""Checks that a downloaded workbook is complete before it is promoted"""
+
+from hashlib import sha256
+from pathlib import Path
+from struct import calcsize, unpack
+
+from ods_retry import RetryableError
+
+# Every XLSX is a zip archive and starts with a local file header
+ZIP_SIGNATURE = b"PK\x03\x04"
+CENTRAL_SIGNATURE = b"PK\x01\x02"
+END_SIGNATURE = b"PK\x05\x06"
+END_FORMAT = "<4s4H2LH"
+END_SIZE = calcsize(END_FORMAT)
+MAX_COMMENT_SIZE = 0xFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+WORKBOOK_PARTS = (b"[Content_Types].xml", b"xl/workbook.xml")
+
+# Listing sizes are rounded ('Descargar 281KB'), so they only bound the real size
+SIZE_TOLERANCE = 0.1
+SIZE_SLACK = 1024
+
+
+class IntegrityError(RetryableError):
+    """
+    Raised for a truncated or bogus download; only that document is fetched again.
+    """
+
+
+def size_bounds(expected_size: None | int) -> tuple[int, float]:
+    if not expected_size:
+        return 0, float("inf")
+    slack = max(SIZE_SLACK, expected_size * SIZE_TOLERANCE)
+    return max(0, int(expected_size - slack)), expected_size + slack
+
+
+def check_central_directory(file_path: Path, size: int) -> None:
+    """
+    Reads the end of the archive and its central directory, which a
+    truncated transfer is the first to lose.
+    """
+    with open(file_path, "rb") as file:
+        tail_size = min(size, END_SIZE + MAX_COMMENT_SIZE)
+        file.seek(size - tail_size)
+        tail = file.read(tail_size)
+        position = tail.rfind(END_SIGNATURE)
+        if position < 0 or tail_size - position < END_SIZE:
+            raise IntegrityError("no end of central directory, the file is truncated")
+
+        _, _, _, _, entries, directory_size, directory_offset, _ = unpack(END_FORMAT, tail[position:position + END_SIZE])
+        if directory_offset == ZIP64_MARKER:
+            # Workbooks never get this large; zipfile can check these itself
+            return
+        if entries == 0 or directory_offset + directory_size != size - tail_size + position:
+            raise IntegrityError("central directory does not match the end of the archive")
+
+        file.seek(directory_offset)
+        directory = file.read(directory_size)
+
+    if not directory.startswith(CENTRAL_SIGNATURE):
+        raise IntegrityError("central directory is corrupt")
+    if not all(part in directory for part in WORKBOOK_PARTS):
+        raise IntegrityError("zip archive is not a workbook")
+
+
+class WorkbookValidator:
+    """
+    Fed every chunk as it is written: hashes it, rejects anything that is
+    not a zip archive from its first bytes on and anything growing past the
+    listed size. finish() then checks the size and the central directory.
+    """
+    def __init__(self, expected_size: None | int = None) -> None:
+        self.minimum_size, self.maximum_size = size_bounds(expected_size)
+        self.expected_size = expected_size
+        self.digest = sha256()
+        self.size = 0
+        self.head = b""
+
+
+    def update(self, chunk: bytes) -> None:
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        if len(self.head) < len(ZIP_SIGNATURE):
+            self.head += chunk[:len(ZIP_SIGNATURE) - len(self.head)]
+            if self.head != ZIP_SIGNATURE[:len(self.head)]:
+                raise IntegrityError(f"not a zip archive (starts with {self.head!r})")
+        if self.size > self.maximum_size:
+            raise IntegrityError(f"{self.size} bytes is more than the listed {self.expected_size}")
+
+
+    def finish(self, file_path: Path) -> str:
+        """
+        Validates the complete file and returns its sha256.
+        """
+        if self.head != ZIP_SIGNATURE:
+            raise IntegrityError(f"not a zip archive ({self.size} bytes)")
+        if self.size < self.minimum_size:
+            raise IntegrityError(f"{self.size} bytes is less than the listed {self.expected_size}")
+        check_central_directory(file_path, size=self.size)
+        return self.digest.hexdigest()
@@ -0,0 +1,89 @@
+"""AIMD concurrency limiter for requests against the CND server"""
+
+from threading import Condition
+from time import perf_counter
+
+
+class AIMDLimiter:
+    """
+    Grows the in-flight limit additively while the server is healthy
+    and cuts it multiplicatively on 429/5xx/timeouts or slow responses.
+    """
+    def __init__(
+            self,
+            name: str,
+            initial: int = 2,
+            minimum: int = 1,
+            maximum: int = 16,
+            latency_target: float = 2.0,
+            error_threshold: float = 0.1,
+            backoff: float = 0.5
+            ) -> None:
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.error_threshold = error_threshold
+        self.backoff = backoff
+
+        self.limit = float(initial)
+        self.in_flight = 0
+        self.latency = 0.0
+        self.error_rate = 0.0
+        self.successes = 0
+        self.failures = 0
+        self._condition = Condition()
+
+
+    def acquire(self) -> float:
+        """
+        Blocks until a slot is free and returns the start timestamp.
+        """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return perf_counter()
+
+
+    def release(self, started: float, is_successful: bool, is_overloaded: bool = False, latency: float | None = None) -> None:
+        """
+        Frees a slot and adjusts the limit from the observed outcome.
+        """
+        if latency is None:
+            latency = perf_counter() - started
+        with self._condition:
+            self.in_flight -= 1
+
+            # Exponentially weighted views of latency and error rate
+            self.latency = latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+            self.error_rate = 0.9 * self.error_rate + (0.0 if is_successful else 0.1)
+
+            if is_overloaded or latency > self.latency_target:
+                self.failures += 1
+                self.limit = max(self.minimum, self.limit * self.backoff)
+            elif is_successful:
+                self.successes += 1
+                if self.error_rate < self.error_threshold:
+                    # One extra slot per window of successful requests
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            else:
+                self.failures += 1
+
+            self._condition.notify_all()
+
+
+    def snapshot(self) -> dict:
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "latency_ms": round(self.latency * 1000, 1),
+                "error_rate": round(self.error_rate, 3),
+                "successes": self.successes,
+                "failures": self.failures,
+            }
+
+
+def is_overload_status(status_code: int) -> bool:
+    return status_code == 429 or status_code >= 500
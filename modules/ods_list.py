@@ -0,0 +1,29 @@
+"""Listing-only mode: prints the available documents as JSON lines"""
+
+from json import dumps
+from urllib.parse import urlsplit
+
+from ods_backfill import PAGE_SIZE
+from ods_cache import ListingCache
+from ods_http import CND
+from ods_retry import Deadline, retry
+
+
+def list_documents(reports: list[dict], cache: ListingCache, deadline: Deadline, max_rows: int = PAGE_SIZE) -> None:
+    """
+    Emits one JSON object per listed document, serving repeated calls from the cache.
+    """
+    for report in reports:
+        engine = CND(name=report["name"], url=report["url"])
+        rows = cache.get_or_fetch(
+            key=ListingCache.key_for(report, max_rows=max_rows),
+            fetch=lambda: retry(
+                lambda: list(engine.iter_listing(max_rows=max_rows, deadline=deadline)),
+                host=urlsplit(report["url"]).netloc,
+                deadline=deadline,
+                label=report["name"]
+                )
+            )
+
+        for row in rows:
+            print(dumps({"report": report["name"], **row}, ensure_ascii=False))
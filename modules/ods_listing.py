@@ -0,0 +1,124 @@
+"""Streaming parser for interactive report listings"""
+
+import re
+from codecs import getincrementaldecoder
+from html.parser import HTMLParser
+from typing import Callable, Iterable, Iterator
+from urllib.parse import parse_qs, urljoin, urlsplit
+
+from ods_profile import phase
+
+
+SIZE_PATTERN = re.compile(r"([\d.,]+)\s*(B|KB|MB|GB)", re.I)
+DATE_PATTERN = re.compile(r"(\d{2})\.(\d{2})\.(\d{4})")
+SIZE_UNITS = {"B": 1, "KB": 1024, "MB": 1024 ** 2, "GB": 1024 ** 3}
+
+
+def parse_size(title: str) -> int | None:
+    """
+    Turns a link title such as 'Descargar 281KB' into bytes.
+    """
+    match = SIZE_PATTERN.search(title or "")
+    if not match:
+        return None
+    return int(float(match.group(1).replace(",", ".")) * SIZE_UNITS[match.group(2).upper()])
+
+
+class ListingParser(HTMLParser):
+    """
+    Incremental parser that turns report rows into compact records as
+    soon as each </tr> is seen, ignoring everything outside the rows.
+    """
+    def __init__(self, base_url: str) -> None:
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.rows: list[dict] = []
+        self._cells: list[str] | None = None
+        self._text: list[str] | None = None
+        self._link: dict | None = None
+
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag == "tr":
+            self._cells, self._link = [], None
+        elif tag == "td" and self._cells is not None:
+            self._text = []
+        elif tag == "a" and self._cells is not None:
+            attributes = dict(attrs)
+            href = attributes.get("href") or ""
+            if "download" in attributes and "get_blob" in href:
+                self._link = {"href": href, "title": attributes.get("title") or ""}
+
+
+    def handle_data(self, data: str) -> None:
+        if self._text is not None:
+            self._text.append(data)
+
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "td" and self._text is not None:
+            self._cells.append(" ".join("".join(self._text).split()))
+            self._text = None
+        elif tag == "tr" and self._cells is not None:
+            if self._text is not None:
+                self.handle_endtag("td")
+            if self._cells and self._link:
+                self.rows.append(self._record())
+            self._cells, self._link = None, None
+
+
+    def _record(self) -> dict:
+        url = urljoin(self.base_url, self._link["href"])
+        published = None
+        for cell in self._cells[1:]:
+            match = DATE_PATTERN.search(cell)
+            if match:
+                day, month, year = match.groups()
+                published = f"{year}-{month}-{day}"
+                break
+
+        return {
+            "name": self._cells[0],
+            "url": url,
+            "k1": parse_qs(urlsplit(url).query).get("k1", [None])[0],
+            "size": parse_size(self._link["title"]),
+            "published": published,
+        }
+
+
+def iter_rows(
+        chunks: Iterable[str | bytes],
+        base_url: str,
+        limit: int | None = None,
+        stop: Callable[[dict], bool] | None = None
+        ) -> Iterator[dict]:
+    """
+    Yields rows while reading chunks, stopping after limit rows or once
+    stop(row) is true so the rest of the response is never read.
+    """
+    parser = ListingParser(base_url=base_url)
+    decoder = getincrementaldecoder("utf-8")(errors="replace")
+    emitted = 0
+    for chunk in chunks:
+        with phase("parse"):
+            parser.feed(decoder.decode(chunk) if isinstance(chunk, bytes) else chunk)
+        rows, parser.rows = parser.rows, []
+        for row in rows:
+            if stop is not None and stop(row):
+                return
+            yield row
+            emitted += 1
+            if limit is not None and emitted >= limit:
+                return
+
+    with phase("parse"):
+        parser.close()
+    for row in parser.rows:
+        if (stop is not None and stop(row)) or (limit is not None and emitted >= limit):
+            return
+        yield row
+        emitted += 1
+
+
+def parse_rows(fragment: str, base_url: str, limit: int | None = None) -> list[dict]:
+    return list(iter_rows([fragment], base_url=base_url, limit=limit))
@@ -0,0 +1,174 @@
+"""Cross-process file locks and the single-instance run lock"""
+
+from contextlib import contextmanager
+from json import dumps, loads
+from os import getpid, kill
+from pathlib import Path
+from socket import gethostname
+from sys import platform
+from time import sleep, time
+from typing import IO, Iterator
+
+from ods_log import get_logger
+
+if platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
+log = get_logger("lock")
+
+
+class LockBusy(Exception):
+    """
+    Raised by non-blocking lock attempts on a held lock.
+    """
+
+
+def acquire(file: IO, blocking: bool = True) -> None:
+    try:
+        if platform == "win32":
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (BlockingIOError, PermissionError, OSError) as e:
+        if blocking:
+            raise
+        raise LockBusy(file.name) from e
+
+
+def release(file: IO) -> None:
+    if platform == "win32":
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(lock_path: Path, blocking: bool = True) -> Iterator[IO]:
+    """
+    Holds an exclusive lock on lock_path for the duration of the block.
+    """
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "a+") as file:
+        acquire(file, blocking=blocking)
+        try:
+            yield file
+        finally:
+            release(file)
+
+
+def is_process_alive(pid: int) -> bool:
+    if platform == "win32":
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+
+    try:
+        kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class RunLock:
+    """
+    Single-instance lock for cron runs. The holder's pid, host, start time
+    and expiry are kept in the lock file. The holder sets its own expiry,
+    max_age from now, so contenders with a shorter max_age still honour a
+    long-lived holder. On the holder's host the lock is stale only once its
+    process is gone; other hosts cannot check the pid and go by the expiry.
+    """
+    def __init__(self, lock_path: Path, max_age: float) -> None:
+        self.lock_path = lock_path
+        self.max_age = max_age
+        self.is_held = False
+
+
+    def holder(self) -> None | dict:
+        try:
+            return loads(self.lock_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+    def guard(self):
+        # Serialises check-and-write between racing invocations
+        return file_lock(self.lock_path.with_name(f"{self.lock_path.name}.guard"))
+
+
+    def is_stale(self, holder: dict) -> bool:
+        if holder["host"] == gethostname():
+            return not is_process_alive(holder["pid"])
+        # Locks written before expiries were recorded fall back to our own max_age
+        return time() > holder.get("expires", holder["started"] + self.max_age)
+
+
+    def is_ours(self, holder: None | dict) -> bool:
+        return holder is not None and holder["pid"] == getpid() and holder["host"] == gethostname()
+
+
+    def write(self, started: float) -> None:
+        temp_lock_path = self.lock_path.with_name(f"{self.lock_path.name}.{getpid()}.tmp")
+        temp_lock_path.write_text(dumps({"pid": getpid(), "host": gethostname(), "started": started, "expires": time() + self.max_age}))
+        temp_lock_path.replace(self.lock_path)
+
+
+    def acquire(self) -> bool:
+        with self.guard():
+            holder = self.holder()
+            if holder is not None and not self.is_stale(holder):
+                return False
+            if holder is not None:
+                log.warning("Taking over stale lock of pid %s on %s.", holder["pid"], holder["host"])
+            self.write(started=time())
+            self.is_held = True
+            return True
+
+
+    def refresh(self) -> bool:
+        """
+        Heartbeat for long-lived holders: pushes the expiry max_age ahead.
+        Returns False, and stops holding, when the lock was taken over.
+        """
+        if not self.is_held:
+            return False
+        with self.guard():
+            holder = self.holder()
+            if not self.is_ours(holder):
+                log.error("The run lock was taken over by pid %s on %s.", holder and holder["pid"], holder and holder["host"])
+                self.is_held = False
+                return False
+            self.write(started=holder["started"])
+            return True
+
+
+    def release(self) -> None:
+        if not self.is_held:
+            return
+        with self.guard():
+            if self.is_ours(self.holder()):
+                self.lock_path.unlink(missing_ok=True)
+        self.is_held = False
+
+
+    def wait(self, timeout: float, interval: float = 1.0) -> None | dict:
+        """
+        Blocks until the current holder is gone or stale; returns that holder.
+        """
+        holder = self.holder()
+        waited = 0.0
+        while waited < timeout:
+            current = self.holder()
+            if current is None or current != holder or self.is_stale(current):
+                return holder
+            sleep(interval)
+            waited += interval
+        return holder
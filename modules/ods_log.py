@@ -0,0 +1,68 @@
+"""Structured logging: callers only enqueue records, a background thread writes them"""
+
+import logging
+from atexit import register
+from json import dumps
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from sys import stderr
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+FIELDS = ("report", "phase", "duration_ms", "bytes", "host")
+
+logger = logging.getLogger("ods")
+_listener: None | QueueListener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record with the known structured fields.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        event = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                event[field] = value
+        return dumps(event, ensure_ascii=False)
+
+
+def configure(level: str = "INFO", is_json: bool = False) -> None:
+    """
+    Routes the "ods" loggers through a queue drained by a listener thread,
+    so a slow terminal or pipe never blocks the hot loops.
+    """
+    global _listener
+    shutdown()
+
+    handler = logging.StreamHandler(stderr)
+    handler.setFormatter(JSONFormatter() if is_json else logging.Formatter("%(message)s"))
+    queue: SimpleQueue = SimpleQueue()
+    logger.handlers[:] = [QueueHandler(queue)]
+    logger.setLevel(level)
+    logger.propagate = False
+
+    _listener = QueueListener(queue, handler)
+    _listener.start()
+
+
+def shutdown() -> None:
+    """
+    Flushes what is queued and stops the listener.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logger.getChild(name)
+
+
+register(shutdown)
@@ -0,0 +1,41 @@
+"""Process-wide metrics registry dumped for monitoring"""
+
+from json import dumps
+from pathlib import Path
+from threading import Lock
+from typing import Callable
+
+
+_sources: dict[str, Callable[[], dict]] = {}
+_sources_lock = Lock()
+
+
+def register(name: str, source: Callable[[], dict]) -> None:
+    """
+    Registers a callable returning a snapshot under name.
+    """
+    with _sources_lock:
+        _sources[name] = source
+
+
+def clear() -> None:
+    """
+    Drops every source, such as those a forked worker inherits from its parent.
+    """
+    with _sources_lock:
+        _sources.clear()
+
+
+def collect() -> dict:
+    with _sources_lock:
+        sources = dict(_sources)
+    return {name: source() for name, source in sources.items()}
+
+
+def dump(file_path: Path) -> None:
+    """
+    Atomically writes the current snapshot as JSON.
+    """
+    temp_file_path = file_path.with_name(f"{file_path.name}.tmp")
+    temp_file_path.write_text(dumps(collect(), indent=2))
+    temp_file_path.replace(file_path)
@@ -0,0 +1,169 @@
+"""Download notifications: a JSON lines queue file plus Unix socket doorbells"""
+
+import socket
+from json import dumps, loads
+from os import getpid
+from pathlib import Path
+from time import sleep
+from typing import Iterator
+
+from ods_lock import file_lock
+
+EVENTS_FILE_NAME = "events.jsonl"
+SUBSCRIBERS_FOLDER_NAME = "subscribers"
+POLL_INTERVAL = 5.0
+
+# Windows builds may lack AF_UNIX; the queue file alone still works there
+HAS_UNIX_SOCKETS = hasattr(socket, "AF_UNIX")
+
+_folder_path: None | Path = None
+
+
+def configure(folder_path: Path) -> None:
+    """
+    Enables publishing into folder_path for this process.
+    """
+    global _folder_path
+    folder_path.joinpath(SUBSCRIBERS_FOLDER_NAME).mkdir(parents=True, exist_ok=True)
+    _folder_path = folder_path
+
+
+def publish(event: dict) -> None:
+    """
+    Appends event to the queue file and rings every live subscriber.
+    A no-op until configure() has been called.
+    """
+    if _folder_path is None:
+        return
+
+    line = dumps(event, ensure_ascii=False) + "\n"
+    events_path = _folder_path.joinpath(EVENTS_FILE_NAME)
+    with file_lock(events_path.with_suffix(".lock")):
+        with open(events_path, "a", encoding="utf-8") as file:
+            file.write(line)
+
+    if not HAS_UNIX_SOCKETS:
+        return
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sender:
+        sender.setblocking(False)
+        for socket_path in _folder_path.joinpath(SUBSCRIBERS_FOLDER_NAME).glob("*.sock"):
+            try:
+                sender.sendto(line.encode(), str(socket_path))
+            except (ConnectionRefusedError, FileNotFoundError):
+                # The subscriber is gone; it catches up from its offset when it returns
+                socket_path.unlink(missing_ok=True)
+            except (BlockingIOError, OSError):
+                # A full receive buffer only delays it until its next poll
+                pass
+
+
+def document_event(report: str, document: dict, download: dict) -> dict:
+    return {
+        "report": report,
+        "name": document["name"],
+        "published": document.get("published"),
+        "path": str(download["path"]),
+        "bytes": download["bytes"],
+        "sha256": download["sha256"],
+    }
+
+
+class Subscriber:
+    """
+    Follows the queue file from a saved offset, so nothing published
+    while the subscriber was down is lost, and wakes up on doorbells.
+    The offset only moves past events the caller has handled; anything
+    read but not committed is delivered again after a restart.
+    """
+    def __init__(self, folder_path: Path, name: str, poll_interval: float = POLL_INTERVAL) -> None:
+        self.events_path = folder_path.joinpath(EVENTS_FILE_NAME)
+        self.offset_path = folder_path.joinpath(SUBSCRIBERS_FOLDER_NAME, f"{name}.offset")
+        self.socket_path = folder_path.joinpath(SUBSCRIBERS_FOLDER_NAME, f"{name}.sock")
+        self.poll_interval = poll_interval
+        self.offset_path.parent.mkdir(parents=True, exist_ok=True)
+
+        try:
+            self.offset = int(self.offset_path.read_text())
+        except (FileNotFoundError, ValueError):
+            self.offset = 0
+        self.read_offset = self.offset
+
+        self.doorbell = None
+        if HAS_UNIX_SOCKETS:
+            self.socket_path.unlink(missing_ok=True)
+            self.doorbell = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.doorbell.bind(str(self.socket_path))
+            self.doorbell.settimeout(poll_interval)
+
+
+    def commit(self, offset: None | int = None) -> None:
+        """
+        Marks everything up to offset, by default everything read so far, as handled.
+        """
+        self.offset = self.read_offset if offset is None else offset
+        temp_offset_path = self.offset_path.with_name(f"{self.offset_path.name}.{getpid()}.tmp")
+        temp_offset_path.write_text(str(self.offset))
+        temp_offset_path.replace(self.offset_path)
+
+
+    def read(self) -> list[tuple[int, dict]]:
+        """
+        Events appended past what was already read, each with the offset just after it.
+        """
+        try:
+            with open(self.events_path, "rb") as file:
+                file.seek(self.read_offset)
+                data = file.read()
+        except FileNotFoundError:
+            return []
+
+        # Only whole lines; a line being written is picked up next time
+        data = data[:data.rfind(b"\n") + 1]
+        events = []
+        for line in data.splitlines(keepends=True):
+            self.read_offset += len(line)
+            if line.strip():
+                events.append((self.read_offset, loads(line)))
+        return events
+
+
+    def pending(self) -> list[dict]:
+        """
+        Events appended since the last call; call commit() once they are handled.
+        """
+        return [event for _, event in self.read()]
+
+
+    def wait(self) -> None:
+        if self.doorbell is None:
+            sleep(self.poll_interval)
+            return
+        try:
+            self.doorbell.recv(65536)
+            # Drain any further doorbells; one read of the file covers them all
+            self.doorbell.setblocking(False)
+            while True:
+                self.doorbell.recv(65536)
+        except (BlockingIOError, socket.timeout):
+            pass
+        finally:
+            self.doorbell.settimeout(self.poll_interval)
+
+
+    def __iter__(self) -> Iterator[dict]:
+        """
+        Commits each event when the next one is asked for, i.e. once the
+        loop body has handled it.
+        """
+        while True:
+            for offset, event in self.read():
+                yield event
+                self.commit(offset)
+            self.wait()
+
+
+    def close(self) -> None:
+        if self.doorbell is not None:
+            self.doorbell.close()
+            self.socket_path.unlink(missing_ok=True)
@@ -0,0 +1,97 @@
+"""Per-phase CPU and allocation profiling behind --profile"""
+
+import cProfile
+import tracemalloc
+from atexit import register
+from contextlib import contextmanager
+from json import dumps
+from pathlib import Path
+from threading import current_thread, main_thread
+from time import perf_counter
+from typing import Iterator
+
+from ods_log import get_logger
+
+TOP_ALLOCATIONS = 25
+
+_run_path: None | Path = None
+_profiles: dict[str, cProfile.Profile] = {}
+_summary: dict[str, dict] = {}
+_stack: list[str] = []
+_first_snapshots: dict[str, tracemalloc.Snapshot] = {}
+_last_snapshots: dict[str, tracemalloc.Snapshot] = {}
+_overhead = 0.0
+
+log = get_logger("profile")
+
+
+def configure(run_path: Path) -> None:
+    """
+    Enables profiling for this process; results are written to run_path at exit.
+    """
+    global _run_path
+    run_path.mkdir(parents=True, exist_ok=True)
+    _run_path = run_path
+    tracemalloc.start()
+    register(finish)
+    log.info("Profiling into %s", run_path)
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """
+    Attributes the enclosed work to phase name. Works as a decorator too.
+    Nested phases pause the enclosing one, so each profile only holds its
+    own work. Only the main thread is profiled.
+    """
+    global _overhead
+    if _run_path is None or current_thread() is not main_thread():
+        yield
+        return
+
+    started = perf_counter()
+    if _stack:
+        _profiles[_stack[-1]].disable()
+    profile = _profiles.setdefault(name, cProfile.Profile())
+    entry = _summary.setdefault(name, {"calls": 0, "seconds": 0.0, "peak_traced_mb": 0.0})
+    if name not in _first_snapshots:
+        _first_snapshots[name] = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    _stack.append(name)
+    overhead = _overhead + perf_counter() - started
+    _overhead = overhead
+    tic = perf_counter()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        toc = perf_counter()
+        # Time spent in nested phases' bookkeeping is not this phase's work
+        entry["calls"] += 1
+        entry["seconds"] += toc - tic - (_overhead - overhead)
+        entry["peak_traced_mb"] = max(entry["peak_traced_mb"], tracemalloc.get_traced_memory()[1] / 2**20)
+        _stack.pop()
+        _last_snapshots[name] = tracemalloc.take_snapshot()
+        if _stack:
+            _profiles[_stack[-1]].enable()
+        _overhead += perf_counter() - toc
+
+
+def finish() -> None:
+    """
+    Writes per phase a .prof (pstats, snakeviz), a .tracemalloc snapshot
+    (tracemalloc.Snapshot.load) and its top allocations, plus a summary.
+    """
+    if _run_path is None:
+        return
+    for name, profile in _profiles.items():
+        profile.dump_stats(str(_run_path.joinpath(f"{name}.prof")))
+
+    for name, snapshot in _last_snapshots.items():
+        snapshot.dump(str(_run_path.joinpath(f"{name}.tracemalloc")))
+        statistics = snapshot.compare_to(_first_snapshots[name], "lineno")[:TOP_ALLOCATIONS]
+        _run_path.joinpath(f"{name}.alloc.txt").write_text("".join(f"{statistic}\n" for statistic in statistics))
+
+    summary = {name: {**entry, "seconds": round(entry["seconds"], 3), "peak_traced_mb": round(entry["peak_traced_mb"], 2)} for name, entry in _summary.items()}
+    _run_path.joinpath("summary.json").write_text(dumps(summary, indent=2))
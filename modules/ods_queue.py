@@ -0,0 +1,158 @@
+"""Durable SQLite work queue with leases for sharded backfills"""
+
+import sqlite3
+from contextlib import contextmanager
+from json import dumps, loads
+from pathlib import Path
+from threading import Event, Thread
+from time import time
+from typing import Iterator
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (status, lease_expires);
+"""
+
+
+class WorkQueue:
+    """
+    Tasks are leased for a visibility timeout; an expired lease makes the
+    task visible again, and completion only counts for the current owner.
+
+    Workers must run on the host that owns the file: WAL relies on shared
+    memory, which network filesystems do not provide.
+    """
+    def __init__(self, file_path: Path, max_attempts: int = 5) -> None:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file_path = file_path
+        self.max_attempts = max_attempts
+        self.connection = sqlite3.connect(file_path, timeout=60, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+
+
+    def enqueue(self, kind: str, key: str, payload: dict) -> bool:
+        """
+        Adds a task once; enqueueing an existing key is a no-op.
+        """
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO tasks (key, kind, payload, updated) VALUES (?, ?, ?, ?)",
+            (key, kind, dumps(payload), time()),
+        )
+        return cursor.rowcount == 1
+
+
+    def lease(self, owner: str, visibility_timeout: float = 300) -> None | dict:
+        """
+        Claims the oldest visible task for owner.
+        """
+        now = time()
+        # IMMEDIATE takes the write lock up front so two workers never claim the same row
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute(
+                "SELECT key, kind, payload, attempts FROM tasks "
+                "WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) "
+                "ORDER BY rowid LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                self.connection.execute("COMMIT")
+                return None
+
+            self.connection.execute(
+                "UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1, updated = ? WHERE key = ?",
+                (owner, now + visibility_timeout, now, row["key"]),
+            )
+            self.connection.execute("COMMIT")
+        except Exception:
+            self.connection.execute("ROLLBACK")
+            raise
+
+        return {"key": row["key"], "kind": row["kind"], "payload": loads(row["payload"]), "attempts": row["attempts"] + 1}
+
+
+    def extend(self, key: str, owner: str, visibility_timeout: float = 300) -> bool:
+        cursor = self.connection.execute(
+            "UPDATE tasks SET lease_expires = ?, updated = ? WHERE key = ? AND owner = ? AND status = 'leased'",
+            (time() + visibility_timeout, time(), key, owner),
+        )
+        return cursor.rowcount == 1
+
+
+    @contextmanager
+    def keep_leased(self, key: str, owner: str, visibility_timeout: float = 300) -> Iterator[None]:
+        """
+        Extends the lease every third of the visibility timeout while the
+        block runs, so a slow task never becomes visible to other workers.
+        """
+        stopped = Event()
+
+        def heartbeat() -> None:
+            # Connections cannot cross threads; the heartbeat has its own
+            queue = WorkQueue(file_path=self.file_path, max_attempts=self.max_attempts)
+            try:
+                while not stopped.wait(visibility_timeout / 3):
+                    try:
+                        queue.extend(key=key, owner=owner, visibility_timeout=visibility_timeout)
+                    except sqlite3.OperationalError:
+                        # Busy database; the next beat still comes well before expiry
+                        pass
+            finally:
+                queue.close()
+
+        thread = Thread(target=heartbeat, name=f"lease-{key}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+
+    def complete(self, key: str, owner: str) -> bool:
+        """
+        Marks a task done; repeated or stale completions change nothing.
+        """
+        cursor = self.connection.execute(
+            "UPDATE tasks SET status = 'done', lease_expires = 0, updated = ? WHERE key = ? AND owner = ? AND status = 'leased'",
+            (time(), key, owner),
+        )
+        return cursor.rowcount == 1
+
+
+    def release(self, key: str, owner: str, error: str) -> None:
+        """
+        Returns a failed task to the queue, or parks it after max_attempts.
+        """
+        self.connection.execute(
+            "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "lease_expires = 0, error = ?, updated = ? WHERE key = ? AND owner = ? AND status = 'leased'",
+            (self.max_attempts, error, time(), key, owner),
+        )
+
+
+    def is_drained(self) -> bool:
+        row = self.connection.execute("SELECT COUNT(*) FROM tasks WHERE status IN ('pending', 'leased')").fetchone()
+        return row[0] == 0
+
+
+    def counts(self) -> dict:
+        rows = self.connection.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        return {status: total for status, total in rows}
+
+
+    def close(self) -> None:
+        self.connection.close()
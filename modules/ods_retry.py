@@ -0,0 +1,231 @@
+"""Retry policy with exponential backoff, jitter and per-host circuit breakers"""
+
+from contextlib import contextmanager
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterator, TypeVar
+
+from ods_log import get_logger
+
+
+T = TypeVar("T")
+
+log = get_logger("retry")
+
+# Per step: the share of what is left of the run it may use, and a ceiling in seconds
+STEP_BUDGETS = {
+    "navigate": (0.25, 60),
+    "ready": (0.25, 30),
+    "extract": (0.1, 30),
+    "download": (0.5, 300),
+}
+MIN_STEP_SECONDS = 1.0
+
+_step_stats: dict[str, dict] = {}
+_step_stats_lock = Lock()
+_exhausted_by: None | str = None
+
+# Transport and browser failures matched by name so no engine has to be imported here
+RETRYABLE_ERROR_NAMES = {
+    "ConnectionError",
+    "ConnectTimeout",
+    "ReadTimeout",
+    "Timeout",
+    "ChunkedEncodingError",
+    "RemoteDisconnected",
+    "RemoteProtocolError",
+    "TimeoutException",
+    "StaleElementReferenceException",
+    "NoSuchElementException",
+}
+
+
+class RetryableError(Exception):
+    """
+    Raised for failures that are worth another attempt (429, 5xx, bad pages).
+    """
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a host whose breaker is open.
+    """
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the run deadline leaves no time for another attempt.
+    """
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Classifies an error as transient or permanent.
+    """
+    if isinstance(error, (RetryableError, TimeoutError, ConnectionError)):
+        return True
+    return any(cls.__name__ in RETRYABLE_ERROR_NAMES for cls in type(error).__mro__)
+
+
+class Deadline:
+    """
+    Wall-clock budget for a whole run.
+    """
+    def __init__(self, seconds: float) -> None:
+        self.seconds = seconds
+        self.expires_at = monotonic() + seconds
+
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - monotonic())
+
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+    def check(self) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"run deadline of {self.seconds:g}s exceeded")
+
+
+    def budget(self, name: str) -> float:
+        """
+        Timeout for one step: its share of what is left, within its ceiling.
+        """
+        share, ceiling = STEP_BUDGETS[name]
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"no time left for {name}")
+        return min(remaining, ceiling, max(MIN_STEP_SECONDS, remaining * share))
+
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[float]:
+        """
+        Yields the step's timeout and records how long it took and whether it timed out.
+        """
+        global _exhausted_by
+        tic = monotonic()
+        is_timed_out = False
+        try:
+            yield self.budget(name)
+        except Exception as e:
+            is_timed_out = isinstance(e, (DeadlineExceeded, TimeoutError)) or "Timeout" in type(e).__name__
+            raise
+        finally:
+            with _step_stats_lock:
+                stats = _step_stats.setdefault(name, {"calls": 0, "seconds": 0.0, "timeouts": 0})
+                stats["calls"] += 1
+                stats["seconds"] += monotonic() - tic
+                stats["timeouts"] += is_timed_out
+                if is_timed_out and self.expired() and _exhausted_by is None:
+                    _exhausted_by = name
+
+
+@contextmanager
+def step(deadline: None | Deadline, name: str) -> Iterator[None | float]:
+    """
+    Deadline.step for callers whose deadline is optional; unbudgeted steps get None.
+    """
+    if deadline is None:
+        yield None
+        return
+    with deadline.step(name) as timeout:
+        yield timeout
+
+
+def step_snapshot() -> dict:
+    with _step_stats_lock:
+        steps = {name: {**stats, "seconds": round(stats["seconds"], 3)} for name, stats in _step_stats.items()}
+    return {"exhausted_by": _exhausted_by, "steps": steps}
+
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated failures and probes again after a cool-down.
+    """
+    def __init__(self, host: str, failure_threshold: int = 5, reset_timeout: float = 60.0) -> None:
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = Lock()
+
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return "closed"
+        if monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "open":
+                raise CircuitOpenError(f"circuit for {self.host} is open")
+
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = monotonic()
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+_breakers_lock = Lock()
+
+
+def get_breaker(host: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host=host)
+        return _breakers[host]
+
+
+def retry(
+        call: Callable[[], T],
+        host: str,
+        deadline: Deadline | None = None,
+        attempts: int = 4,
+        base_delay: float = 1.0,
+        max_delay: float = 30.0,
+        label: str = ""
+        ) -> T:
+    """
+    Runs call until it succeeds, fails permanently or runs out of attempts/time.
+    """
+    breaker = get_breaker(host)
+    for attempt in range(1, attempts + 1):
+        if deadline is not None:
+            deadline.check()
+        breaker.before_call()
+
+        try:
+            result = call()
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            breaker.record_failure()
+            if attempt == attempts:
+                raise
+
+            # Full jitter keeps parallel workers from retrying in lockstep
+            delay = uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+            if deadline is not None and delay >= deadline.remaining():
+                raise DeadlineExceeded(f"no time left to retry {label or host}") from e
+            log.warning("%s: attempt %d failed (%s), retrying in %.1fs...", label or host, attempt, type(e).__name__, delay, extra={"host": host})
+            sleep(delay)
+        else:
+            breaker.record_success()
+            return result
@@ -0,0 +1,148 @@
+"""Polling schedule learned from when each report's documents actually arrived"""
+
+from datetime import date, datetime, timedelta
+from time import time
+
+from ods_state import StateStore
+
+MIN_SAMPLES = 5
+# Listings first seen within this many seconds of each other were paged in bulk (backfills, ranges)
+BULK_SECONDS = 60
+QUANTILES = (0.05, 0.95)
+MARGIN_MINUTES = 15
+# A weekday belongs to the schedule once this share of arrivals fell on it
+WEEKDAY_SHARE = 0.1
+DAY_MINUTES = 24 * 60
+
+
+def arrivals_of(first_seen: list[float]) -> list[float]:
+    """
+    Keeps the first sightings that were made one at a time, i.e. by regular polls.
+    """
+    times = sorted(first_seen)
+    arrivals = []
+    for index, seen in enumerate(times):
+        is_after_previous = index == 0 or seen - times[index - 1] > BULK_SECONDS
+        is_before_next = index == len(times) - 1 or times[index + 1] - seen > BULK_SECONDS
+        if is_after_previous and is_before_next:
+            arrivals.append(seen)
+    return arrivals
+
+
+def minute_of_day(timestamp: float) -> float:
+    moment = datetime.fromtimestamp(timestamp)
+    return moment.hour * 60 + moment.minute + moment.second / 60
+
+
+class PublicationModel:
+    """
+    Daily publication window of one report: the central arrival times-of-day,
+    widened by a margin, on the weekdays documents actually arrive.
+    Windows may wrap around midnight.
+    """
+    def __init__(self, arrivals: list[float], margin_minutes: float = MARGIN_MINUTES) -> None:
+        self.is_trained = len(arrivals) >= MIN_SAMPLES
+        self.start_minute = 0.0
+        self.length_minutes = float(DAY_MINUTES)
+        self.weekdays = set(range(7))
+        if not self.is_trained:
+            return
+
+        # Cut the clock at the widest gap between arrivals so nights are not split
+        minutes = sorted(minute_of_day(arrival) for arrival in arrivals)
+        gaps = [(minutes[(index + 1) % len(minutes)] - minute) % DAY_MINUTES for index, minute in enumerate(minutes)]
+        cut = gaps.index(max(gaps)) + 1
+        unwrapped = [minute if index >= cut else minute + DAY_MINUTES for index, minute in enumerate(minutes)]
+        unwrapped = unwrapped[cut:] + unwrapped[:cut]
+
+        low = unwrapped[int(QUANTILES[0] * (len(unwrapped) - 1))]
+        high = unwrapped[round(QUANTILES[1] * (len(unwrapped) - 1))]
+        self.start_minute = (low - margin_minutes) % DAY_MINUTES
+        self.length_minutes = min(high - low + 2 * margin_minutes, DAY_MINUTES)
+
+        days = [self.window_day(arrival).weekday() for arrival in arrivals]
+        self.weekdays = {weekday for weekday in set(days) if days.count(weekday) / len(days) >= WEEKDAY_SHARE}
+
+
+    def window_day(self, timestamp: float) -> date:
+        """
+        Day whose window a moment belongs to; windows past midnight count for the day they opened.
+        """
+        return (datetime.fromtimestamp(timestamp) - timedelta(minutes=self.start_minute)).date()
+
+
+    def windows(self, now: float) -> list[tuple[float, float]]:
+        """
+        (start, end) of the window open at now, if any, and of the next ones.
+        """
+        first_day = self.window_day(now)
+        windows = []
+        for offset in range(-1, 8):
+            day = first_day + timedelta(days=offset)
+            if day.weekday() not in self.weekdays:
+                continue
+            start = datetime.combine(day, datetime.min.time()) + timedelta(minutes=self.start_minute)
+            end = start + timedelta(minutes=self.length_minutes)
+            if end.timestamp() > now:
+                windows.append((start.timestamp(), end.timestamp()))
+        return windows
+
+
+    def is_open(self, now: float, last_arrival: None | float) -> bool:
+        """
+        Whether now is inside a window whose document has not arrived yet.
+        """
+        if not self.is_trained:
+            return True
+        for start, end in self.windows(now):
+            if start <= now < end:
+                # Arrivals since halfway through the preceding gap belong to this window
+                return last_arrival is None or last_arrival < start - (DAY_MINUTES - self.length_minutes) * 30
+        return False
+
+
+    def delay(self, now: float, last_arrival: None | float, fast: float, slow: float) -> float:
+        if self.is_open(now, last_arrival):
+            return fast
+        for start, _ in self.windows(now):
+            if start > now:
+                return min(slow, start - now)
+        return slow
+
+
+class Scheduler:
+    """
+    Decides which reports are worth polling now, from the state history.
+    """
+    def __init__(self, state: StateStore, fast: float, slow: float) -> None:
+        self.state = state
+        self.fast = fast
+        self.slow = slow
+
+
+    def model(self, report: str) -> tuple[PublicationModel, None | float, None | float]:
+        first_seen, last_polled = self.state.listing_history(report=report)
+        last_arrival = max(first_seen) if first_seen else None
+        return PublicationModel(arrivals_of(first_seen)), last_arrival, last_polled
+
+
+    def due(self, reports: list[dict], now: None | float = None) -> list[dict]:
+        """
+        Reports inside an open window, untrained ones, and any not polled for slow seconds.
+        """
+        now = time() if now is None else now
+        due = []
+        for report in reports:
+            model, last_arrival, last_polled = self.model(report["name"])
+            if last_polled is None or now - last_polled >= self.slow or model.is_open(now, last_arrival):
+                due.append(report)
+        return due
+
+
+    def next_delay(self, reports: list[dict], now: None | float = None) -> float:
+        now = time() if now is None else now
+        delays = []
+        for report in reports:
+            model, last_arrival, _ = self.model(report["name"])
+            delays.append(model.delay(now, last_arrival, fast=self.fast, slow=self.slow))
+        return min(delays, default=self.slow)
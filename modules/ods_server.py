@@ -0,0 +1,203 @@
+"""Local HTTP server for stored documents and their parsed data"""
+
+from csv import writer
+from functools import lru_cache
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
+from json import dumps
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.etree.ElementTree import ParseError
+from zipfile import BadZipFile, ZIP_STORED
+
+from ods_log import get_logger
+from ods_state import StateStore
+from ods_store import locate_document, read_document, split_bundle_path
+from ods_xlsx import read_sheet
+
+XLSX_CONTENT_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+FORMATS = {
+    "json": "application/json; charset=utf-8",
+    "csv": "text/csv; charset=utf-8",
+}
+# Raised by read_sheet on a stored file that is not a readable workbook
+PARSE_ERRORS = (KeyError, IndexError, ValueError, BadZipFile, ParseError)
+
+log = get_logger("server")
+
+
+@lru_cache(maxsize=16)
+def load(path: str, location: str, sha256: str) -> bytes:
+    """
+    Document bytes, kept for the hottest documents. sha256 is part of the
+    key so a replaced file never serves stale bytes.
+    """
+    return read_document(path, location=location)
+
+
+@lru_cache(maxsize=64)
+def render(path: str, location: str, sha256: str, output_format: str) -> bytes:
+    rows = read_sheet(load(path, location, sha256))
+    if output_format == "json":
+        return dumps(rows, ensure_ascii=False).encode()
+
+    buffer = StringIO()
+    writer(buffer).writerows(rows)
+    return buffer.getvalue().encode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    GET /reports
+    GET /reports/<report>/latest[?format=json|csv]
+    GET /reports/<report>/documents?date=YYYY-MM-DD
+    GET /reports/<report>/documents/<name>[?format=json|csv]
+    """
+    server_version = "ODSDownloader"
+    protocol_version = "HTTP/1.1"
+
+
+    @property
+    def state(self) -> StateStore:
+        return self.server.state
+
+
+    def log_message(self, format: str, *args) -> None:
+        """
+        Sends access lines through the queue logger instead of writing to stderr
+        from the request thread.
+        """
+        log.info("%s %s", self.address_string(), format % args)
+
+
+    def log_error(self, format: str, *args) -> None:
+        log.warning("%s %s", self.address_string(), format % args)
+
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/")]
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+        try:
+            if parts == ["reports"] or parts == [""]:
+                latest = {report: self.state.find_documents(report=report, limit=1) for report in self.state.reports()}
+                self.send_json({report: self.describe(rows[0]) for report, rows in latest.items() if rows})
+            elif len(parts) == 3 and parts[0] == "reports" and parts[2] == "latest":
+                self.send_document(self.state.find_documents(report=parts[1], limit=1), query, is_mutable=True)
+            elif len(parts) == 3 and parts[0] == "reports" and parts[2] == "documents":
+                self.send_json([self.describe(row) for row in self.state.find_documents(report=parts[1], day=query.get("date"))])
+            elif len(parts) == 4 and parts[0] == "reports" and parts[2] == "documents":
+                self.send_document(self.state.find_documents(report=parts[1], name=parts[3], limit=1), query, is_mutable=False)
+            else:
+                self.send_error(HTTPStatus.NOT_FOUND)
+        except (FileNotFoundError, KeyError):
+            self.send_error(HTTPStatus.NOT_FOUND, "Document is no longer stored")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+    @staticmethod
+    def describe(row) -> dict:
+        return {
+            "report": row["report"],
+            "name": row["name"],
+            "published": row["published"],
+            "finished": row["finished"],
+            "bytes": row["bytes"],
+            "sha256": row["sha256"],
+        }
+
+
+    def is_fresh(self, etag: str) -> bool:
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is None:
+            return False
+        return if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+
+
+    def send_json(self, payload) -> None:
+        body = dumps(payload, ensure_ascii=False).encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", FORMATS["json"])
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def send_document(self, rows: list, query: dict, is_mutable: bool) -> None:
+        if not rows:
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+
+        row = rows[0]
+        output_format = query.get("format")
+        if output_format is not None and output_format not in FORMATS:
+            self.send_error(HTTPStatus.BAD_REQUEST, f"Unknown format '{output_format}'")
+            return
+
+        etag = f'"{row["sha256"]}-{output_format}"' if output_format else f'"{row["sha256"]}"'
+        cache_control = "no-cache" if is_mutable else "max-age=86400"
+        if self.is_fresh(etag):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            return
+
+        if output_format:
+            # Loaded first: a KeyError here means a bundle lost the document, i.e. 404
+            load(row["path"], row["location"], row["sha256"])
+            try:
+                body = render(row["path"], row["location"], row["sha256"], output_format)
+            except PARSE_ERRORS as e:
+                log.warning("%s is not a readable workbook (%s: %s).", row["name"], type(e).__name__, e, extra={"report": row["report"]})
+                self.send_error(HTTPStatus.UNPROCESSABLE_ENTITY, "Document is not a readable workbook")
+                return
+            self.send_response(HTTPStatus.OK)
+            self.send_header("Content-Type", FORMATS[output_format])
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", cache_control)
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        file_path, offset, entry = locate_document(row["path"], location=row["location"])
+        file_name = split_bundle_path(row["path"])[1] if entry is not None else Path(row["path"]).name
+        is_stored = entry is None or entry["compress_type"] == ZIP_STORED
+        size = file_path.stat().st_size if entry is None else entry["size"]
+        body = None if is_stored else load(row["path"], row["location"], row["sha256"])
+
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", XLSX_CONTENT_TYPE)
+        self.send_header("Content-Length", str(size if body is None else len(body)))
+        self.send_header("Content-Disposition", f'attachment; filename="{file_name}"')
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", cache_control)
+        self.end_headers()
+
+        if body is not None:
+            self.wfile.write(body)
+            return
+        # Loose files and stored bundle members go out straight from the page cache
+        with open(file_path, "rb") as file:
+            self.connection.sendfile(file, offset=offset, count=size)
+
+
+def serve(state: StateStore, port: int, host: str = "127.0.0.1") -> None:
+    """
+    Serves stored documents until interrupted; the CND server is never contacted.
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.state = state
+    log.info("Serving documents on http://%s:%d/reports", host, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nInterrupted by user!")
+    finally:
+        server.server_close()
@@ -0,0 +1,66 @@
+"""Cookies and APEX page state persisted per host between runs"""
+
+from json import dumps, loads
+from os import getpid
+from pathlib import Path
+from time import time
+
+from ods_lock import file_lock
+
+# APEX sessions idle out server-side; older saved state is not worth trying
+SESSION_MAX_AGE = 1800
+
+
+class SessionStore:
+    """
+    One JSON file per host holding its cookies and the page state of each
+    report URL. Stale state, expired cookies and unreadable files are
+    treated as absent.
+    """
+    def __init__(self, folder_path: Path, max_age: float = SESSION_MAX_AGE) -> None:
+        folder_path.mkdir(parents=True, exist_ok=True)
+        self.folder_path = folder_path
+        self.max_age = max_age
+
+
+    def session_path(self, host: str) -> Path:
+        return self.folder_path.joinpath(f"{host.replace(':', '_')}.json")
+
+
+    def load(self, host: str) -> dict:
+        try:
+            session = loads(self.session_path(host).read_text())
+        except (FileNotFoundError, ValueError):
+            return {"cookies": [], "page_states": {}}
+
+        now = time()
+        return {
+            "cookies": [cookie for cookie in session.get("cookies", []) if not cookie.get("expires") or cookie["expires"] > now],
+            "page_states": {
+                url: entry["state"]
+                for url, entry in session.get("page_states", {}).items()
+                if now - entry["saved_at"] <= self.max_age
+            },
+        }
+
+
+    def save(self, host: str, cookies: list[dict], url: str, page_state: None | dict) -> None:
+        """
+        Replaces the host's cookies and stores (or, with None, forgets) the page state of url.
+        """
+        session_path = self.session_path(host)
+        with file_lock(session_path.with_suffix(".lock")):
+            try:
+                session = loads(session_path.read_text())
+            except (FileNotFoundError, ValueError):
+                session = {"page_states": {}}
+
+            session["cookies"] = cookies
+            if page_state is None:
+                session["page_states"].pop(url, None)
+            else:
+                session["page_states"][url] = {"state": page_state, "saved_at": time()}
+
+            temp_session_path = session_path.with_name(f"{session_path.name}.{getpid()}.tmp")
+            temp_session_path.write_text(dumps(session))
+            temp_session_path.replace(session_path)
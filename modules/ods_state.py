@@ -0,0 +1,249 @@
+"""SQLite-backed record of listings seen and download attempts"""
+
+import sqlite3
+from pathlib import Path
+from threading import Lock
+from time import time
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    report TEXT NOT NULL,
+    name TEXT NOT NULL,
+    url TEXT NOT NULL,
+    k1 TEXT,
+    size INTEGER,
+    published TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (report, name)
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY,
+    report TEXT NOT NULL,
+    name TEXT NOT NULL,
+    k1 TEXT,
+    published TEXT,
+    path TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    outcome TEXT NOT NULL DEFAULT 'running',
+    bytes INTEGER,
+    sha256 TEXT,
+    location TEXT NOT NULL DEFAULT 'temp'
+);
+CREATE INDEX IF NOT EXISTS attempts_by_location ON attempts (location, outcome);
+CREATE INDEX IF NOT EXISTS attempts_by_report ON attempts (report, outcome, name);
+"""
+
+# Columns added after the first release; older databases gain them on open
+ADDED_COLUMNS = {
+    "listings": {"k1": "TEXT", "size": "INTEGER", "published": "TEXT"},
+    "attempts": {"k1": "TEXT", "published": "TEXT"},
+}
+INDEXES = "CREATE INDEX IF NOT EXISTS attempts_by_k1 ON attempts (report, outcome, k1);"
+
+
+class StateStore:
+    """
+    Job and document state shared by every run.
+    """
+    def __init__(self, file_path: Path) -> None:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        self.file_path = file_path
+        self.is_new = not file_path.exists()
+        self._lock = Lock()
+        self.connection = sqlite3.connect(file_path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        # WAL lets readers (reports, other workers) proceed while a run writes
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.migrate()
+        self.connection.executescript(INDEXES)
+
+
+    def migrate(self) -> None:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row["name"] for row in self.connection.execute(f"PRAGMA table_info({table})")}
+            for column, column_type in columns.items():
+                if column not in existing:
+                    self.connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+
+    def execute(self, query: str, parameters: tuple = ()) -> list[sqlite3.Row]:
+        with self._lock:
+            return self.connection.execute(query, parameters).fetchall()
+
+
+    def record_listing(self, report: str, document: dict) -> None:
+        now = time()
+        self.execute(
+            "INSERT INTO listings (report, name, url, k1, size, published, first_seen, last_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (report, name) DO UPDATE SET url = excluded.url, k1 = excluded.k1, size = excluded.size, "
+            "published = excluded.published, last_seen = excluded.last_seen",
+            (report, document["name"], document["url"], document.get("k1"), document.get("size"), document.get("published"), now, now),
+        )
+
+
+    def is_known(self, report: str, document: dict) -> bool:
+        """
+        Tells whether document was already downloaded successfully. Documents
+        are told apart by their blob key k1, so one republished under the same
+        name is downloaded again; attempts recorded before k1 was kept, and
+        rows without one, fall back to the name.
+        """
+        k1 = document.get("k1")
+        if k1 is None:
+            rows = self.execute(
+                "SELECT 1 FROM attempts WHERE report = ? AND outcome = 'complete' AND name = ? LIMIT 1",
+                (report, document["name"]),
+            )
+        else:
+            rows = self.execute(
+                "SELECT 1 FROM attempts WHERE report = ? AND outcome = 'complete' AND (k1 = ? OR (k1 IS NULL AND name = ?)) LIMIT 1",
+                (report, k1, document["name"]),
+            )
+        return bool(rows)
+
+
+    def start_attempt(self, report: str, document: dict, file_path: Path) -> tuple[int, Path]:
+        """
+        Records a new attempt and returns it with the path to download to.
+        A document republished under a known name with a new k1 gets the k1
+        appended, so neither version overwrites the other in temp, backup
+        or a bundle.
+        """
+        k1 = document.get("k1")
+        with self._lock:
+            # IMMEDIATE: the name check and the insert are one step for every thread and process
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                if k1 is not None and self.connection.execute(
+                    "SELECT 1 FROM attempts WHERE report = ? AND name = ? AND k1 IS NOT NULL AND k1 != ? AND outcome != 'failed' LIMIT 1",
+                    (report, document["name"], k1),
+                ).fetchone():
+                    file_path = file_path.with_name(f"{file_path.stem}_{k1}{file_path.suffix}")
+                cursor = self.connection.execute(
+                    "INSERT INTO attempts (report, name, k1, published, path, started) VALUES (?, ?, ?, ?, ?, ?)",
+                    (report, document["name"], k1, document.get("published"), str(file_path), time()),
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+            return cursor.lastrowid, file_path
+
+
+    def finish_attempt(self, attempt_id: int, outcome: str, file_path: None | Path = None, size: int | None = None, sha256: str | None = None) -> None:
+        """
+        Without a file_path nothing was written to the destination, so the
+        attempt is left out of clean-up rather than pointing at a file that
+        may belong to another download of the same name.
+        """
+        if file_path is None:
+            self.execute(
+                "UPDATE attempts SET finished = ?, outcome = ?, path = '', location = 'removed', bytes = ?, sha256 = ? WHERE id = ?",
+                (time(), outcome, size, sha256, attempt_id),
+            )
+            return
+        self.execute(
+            "UPDATE attempts SET finished = ?, outcome = ?, path = ?, bytes = ?, sha256 = ? WHERE id = ?",
+            (time(), outcome, str(file_path), size, sha256, attempt_id),
+        )
+
+
+    def pending_cleanup(self) -> list[sqlite3.Row]:
+        """
+        Attempts whose files still sit in the temp folder.
+        """
+        return self.execute("SELECT id, path, outcome, finished FROM attempts WHERE location = 'temp' AND outcome != 'running'")
+
+
+    def move_many(self, moves: list[tuple[str, str, int]]) -> None:
+        """
+        Applies (location, path, attempt_id) updates in one transaction, to
+        attempts still in temp only, so a concurrent clean-up's move stands.
+        """
+        with self._lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("UPDATE attempts SET location = ?, path = ? WHERE id = ? AND location = 'temp'", moves)
+            self.connection.execute("COMMIT")
+
+
+    def move_paths(self, moves: list[tuple[str, str, str]]) -> None:
+        """
+        Applies (location, new path, old path) updates in one transaction.
+        """
+        with self._lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany("UPDATE attempts SET location = ?, path = ? WHERE path = ?", moves)
+            self.connection.execute("COMMIT")
+
+
+    def summary(self) -> dict:
+        """
+        Per-report counts, bytes and mean duration of download attempts.
+        """
+        rows = self.execute(
+            "SELECT report, outcome, COUNT(*) AS total, SUM(bytes) AS bytes, AVG(finished - started) AS duration "
+            "FROM attempts GROUP BY report, outcome"
+        )
+        summary: dict[str, dict] = {}
+        for row in rows:
+            summary.setdefault(row["report"], {})[row["outcome"]] = {
+                "count": row["total"],
+                "bytes": row["bytes"] or 0,
+                "mean_seconds": round(row["duration"] or 0, 3),
+            }
+        return summary
+
+
+    def find_documents(self, report: str, name: None | str = None, day: None | str = None, limit: int = 100) -> list[sqlite3.Row]:
+        """
+        Stored documents of report, latest published first, optionally by name or by
+        the day (YYYY-MM-DD) they were published on. Attempts recorded before
+        publication dates were kept count for the local day they finished.
+        """
+        query = (
+            "SELECT report, name, k1, published, path, location, finished, bytes, sha256 FROM attempts "
+            "WHERE report = ? AND outcome = 'complete' AND location IN ('temp', 'backup', 'bundle')"
+        )
+        parameters: tuple = (report,)
+        if name is not None:
+            query += " AND name = ?"
+            parameters += (name,)
+        if day is not None:
+            query += " AND COALESCE(published, date(finished, 'unixepoch', 'localtime')) = ?"
+            parameters += (day,)
+        # Newest published first: backfills and ranges download old documents last
+        return self.execute(
+            f"{query} ORDER BY COALESCE(published, date(finished, 'unixepoch', 'localtime')) DESC, finished DESC LIMIT ?",
+            parameters + (limit,)
+        )
+
+
+    def reports(self) -> list[str]:
+        return [row["report"] for row in self.execute("SELECT DISTINCT report FROM attempts WHERE outcome = 'complete' ORDER BY report")]
+
+
+    def listing_history(self, report: str) -> tuple[list[float], None | float]:
+        """
+        First sightings of every listed document of report, and when it was last polled.
+        """
+        rows = self.execute("SELECT first_seen, last_seen FROM listings WHERE report = ?", (report,))
+        return [row["first_seen"] for row in rows], max((row["last_seen"] for row in rows), default=None)
+
+
+    def attempts_since(self, started: float) -> list:
+        """
+        Download attempts started at or after started, oldest first.
+        """
+        return self.execute(
+            "SELECT report, name, path, outcome, bytes FROM attempts WHERE started >= ? ORDER BY started",
+            (started,)
+        )
+
+
+    def close(self) -> None:
+        self.connection.close()
@@ -0,0 +1,241 @@
+"""Document store: the temp folder, date-partitioned backups and their upkeep"""
+
+import zlib
+from json import dumps, loads
+from os import makedirs, rename, scandir
+from pathlib import Path
+from shutil import copyfile
+from struct import unpack
+from time import localtime, strftime
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from ods_lock import file_lock
+from ods_log import get_logger
+from ods_profile import phase
+from ods_state import StateStore
+
+
+DOCUMENT_SUFFIXES = (".xlsx", ".xls")
+
+# State paths of bundled documents look like ".../backup/2025/02.zip#name.xlsx"
+BUNDLE_SEPARATOR = "#"
+
+log = get_logger("store")
+
+
+def partition_for(backup_folder_path: Path, timestamp: float) -> Path:
+    """
+    Backups are sharded by year and month so no single folder grows unbounded.
+    """
+    return backup_folder_path.joinpath(strftime("%Y", localtime(timestamp)), strftime("%m", localtime(timestamp)))
+
+
+def sweep_untracked(temp_folder_path: Path, backup_folder_path: Path, remove_unknown: bool) -> tuple[int, int]:
+    """
+    Single scandir pass over files that the state store does not know about.
+    """
+    backed_up = removed = 0
+    created: set[Path] = set()
+    with scandir(temp_folder_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            suffix = Path(entry.name).suffix
+            if suffix in DOCUMENT_SUFFIXES:
+                partition = partition_for(backup_folder_path, entry.stat().st_mtime)
+                if partition not in created:
+                    makedirs(partition, exist_ok=True)
+                    created.add(partition)
+                rename(entry.path, partition.joinpath(entry.name))
+                backed_up += 1
+            elif suffix == ".failed" or remove_unknown:
+                Path(entry.path).unlink(missing_ok=True)
+                removed += 1
+    return backed_up, removed
+
+
+@phase("clean_up")
+def clean_up(state: StateStore, temp_folder_path: Path, backup_folder_path: Path, remove_unknown: bool = False) -> tuple[int, int]:
+    """
+    Removes old failed downloads and backs up completed downloads. One
+    process at a time: backfills are not run-locked but share temp/.
+    """
+    with file_lock(state.file_path.with_name("clean_up.lock")):
+        return _clean_up(state, temp_folder_path, backup_folder_path, remove_unknown=remove_unknown)
+
+
+def _clean_up(state: StateStore, temp_folder_path: Path, backup_folder_path: Path, remove_unknown: bool) -> tuple[int, int]:
+    backed_up = removed = 0
+    if state.is_new:
+        # Files left behind by runs that predate the state database
+        backed_up, removed = sweep_untracked(temp_folder_path, backup_folder_path, remove_unknown=remove_unknown)
+        # Once per store: later passes would also sweep tracked downloads by mtime
+        state.is_new = False
+
+    pending = state.pending_cleanup()
+    if not pending:
+        if backed_up or removed:
+            log.info("Backed up %d, removed %d file(s).", backed_up, removed, extra={"phase": "clean_up"})
+        return backed_up, removed
+
+    moves: list[tuple[str, str, int]] = []
+    created: set[Path] = set()
+    # Older failed attempts recorded the destination path, which may now hold a good download
+    completed = {attempt["path"] for attempt in pending if attempt["outcome"] == "complete"}
+    for attempt in pending:
+        file = Path(attempt["path"])
+        if attempt["outcome"] == "failed":
+            if attempt["path"] and attempt["path"] not in completed:
+                file.unlink(missing_ok=True)
+            moves.append(("removed", str(file), attempt["id"]))
+            removed += 1
+            continue
+
+        partition = partition_for(backup_folder_path, attempt["finished"])
+        if partition not in created:
+            makedirs(partition, exist_ok=True)
+            created.add(partition)
+
+        backup_file = partition.joinpath(file.name)
+        try:
+            rename(file, backup_file)
+        except FileNotFoundError:
+            moves.append(("missing", str(file), attempt["id"]))
+            continue
+        moves.append(("backup", str(backup_file), attempt["id"]))
+        backed_up += 1
+
+    state.move_many(moves)
+    log.info("Backed up %d, removed %d file(s).", backed_up, removed, extra={"phase": "clean_up"})
+    return backed_up, removed
+
+
+def bundle_index_path(bundle_path: Path) -> Path:
+    return bundle_path.with_suffix(".index.json")
+
+
+def build_bundle_index(bundle_path: Path) -> dict[str, dict]:
+    """
+    Maps every member to the offset and length of its data in the bundle.
+    """
+    index = {}
+    with ZipFile(bundle_path) as bundle, open(bundle_path, "rb") as raw:
+        for info in bundle.infolist():
+            # The local header repeats name and extra lengths, which may differ from the central directory
+            raw.seek(info.header_offset + 26)
+            name_length, extra_length = unpack("<HH", raw.read(4))
+            index[info.filename] = {
+                "offset": info.header_offset + 30 + name_length + extra_length,
+                "size": info.compress_size,
+                "file_size": info.file_size,
+                "compress_type": info.compress_type,
+                "crc": info.CRC,
+            }
+    return index
+
+
+def load_bundle_index(bundle_path: Path) -> dict[str, dict]:
+    index_path = bundle_index_path(bundle_path)
+    if not index_path.is_file():
+        index_path.write_text(dumps(build_bundle_index(bundle_path)))
+    return loads(index_path.read_text())
+
+
+def split_bundle_path(path: str) -> tuple[Path, str]:
+    """
+    Splits the stored path of a bundled document into (bundle, member). Only
+    the last component is split: folders above the bundle may contain the separator.
+    """
+    file_path = Path(path)
+    bundle_name, _, member = file_path.name.partition(BUNDLE_SEPARATOR)
+    return file_path.with_name(bundle_name), member
+
+
+def locate_document(path: str, location: str) -> tuple[Path, int, dict | None]:
+    """
+    Resolves a stored path to (file, data offset, bundle entry or None for loose files).
+    """
+    if location != "bundle":
+        return Path(path), 0, None
+
+    bundle_path, member = split_bundle_path(path)
+    entry = load_bundle_index(bundle_path)[member]
+    return bundle_path, entry["offset"], entry
+
+
+def read_document(path: str, location: str) -> bytes:
+    """
+    Reads a document from a loose file or straight out of its bundle.
+    """
+    file_path, offset, entry = locate_document(path, location=location)
+    if entry is None:
+        return file_path.read_bytes()
+
+    with open(file_path, "rb") as file:
+        file.seek(offset)
+        data = file.read(entry["size"])
+
+    if entry["compress_type"] == ZIP_DEFLATED:
+        data = zlib.decompress(data, -15)
+    if zlib.crc32(data) != entry["crc"]:
+        raise ValueError(f"{path} is corrupt")
+    return data
+
+
+def compact(backup_folder_path: Path, state: StateStore | None = None) -> list[Path]:
+    """
+    Packs every closed month of loose backups into one bundle with an index.
+    """
+    current_month = strftime("%Y/%m")
+    bundles = []
+    for year_folder in sorted(backup_folder_path.glob("[0-9][0-9][0-9][0-9]")):
+        for month_folder in sorted(year_folder.glob("[0-9][0-9]")):
+            if not month_folder.is_dir() or f"{year_folder.name}/{month_folder.name}" >= current_month:
+                continue
+
+            with scandir(month_folder) as entries:
+                files = sorted(Path(entry.path) for entry in entries if entry.is_file())
+            if not files:
+                month_folder.rmdir()
+                continue
+
+            bundle_path = year_folder.joinpath(f"{month_folder.name}.zip")
+            temp_bundle_path = bundle_path.with_name(f"{bundle_path.name}.tmp")
+            if bundle_path.exists():
+                copyfile(bundle_path, temp_bundle_path)
+
+            bundled, clashing = [], []
+            with ZipFile(temp_bundle_path, "a") as bundle:
+                existing = set(bundle.namelist())
+                for file in files:
+                    if file.name in existing:
+                        info = bundle.getinfo(file.name)
+                        # The same file, left by a compaction that stopped before removing it
+                        if info.file_size == file.stat().st_size and info.CRC == zlib.crc32(file.read_bytes()):
+                            bundled.append(file)
+                        else:
+                            clashing.append(file)
+                        continue
+                    # Workbooks are already deflated inside; storing them keeps reads a plain slice
+                    compress_type = ZIP_STORED if file.suffix == ".xlsx" else ZIP_DEFLATED
+                    bundle.write(file, arcname=file.name, compress_type=compress_type)
+                    bundled.append(file)
+
+            bundle_index_path(bundle_path).write_text(dumps(build_bundle_index(temp_bundle_path)))
+            temp_bundle_path.replace(bundle_path)
+
+            if state is not None:
+                state.move_paths([("bundle", f"{bundle_path}{BUNDLE_SEPARATOR}{file.name}", str(file)) for file in bundled])
+            for file in bundled:
+                file.unlink()
+            if clashing:
+                log.warning(
+                    "%d file(s) in %s differ from bundle members of the same name and were left in place.",
+                    len(clashing), month_folder, extra={"phase": "compact"}
+                    )
+            else:
+                month_folder.rmdir()
+
+            log.info("Compacted %d file(s) into %s (%s).", len(bundled), bundle_path.name, year_folder.name)
+            bundles.append(bundle_path)
+    return bundles
@@ -0,0 +1,100 @@
+"""Minimal XLSX reader on zipfile and ElementTree, for serving dispatch data"""
+
+from io import BytesIO
+from xml.etree.ElementTree import iterparse
+from zipfile import ZipFile
+
+NAMESPACE = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+RELATIONSHIP_NAMESPACE = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+
+def column_index(reference: str) -> int:
+    """
+    Zero-based column of a cell reference such as "AB12".
+    """
+    index = 0
+    for character in reference:
+        if not character.isalpha():
+            break
+        index = index * 26 + ord(character.upper()) - 64
+    return index - 1
+
+
+def shared_strings(workbook: ZipFile) -> list[str]:
+    try:
+        file = workbook.open("xl/sharedStrings.xml")
+    except KeyError:
+        return []
+
+    strings = []
+    with file:
+        for _, element in iterparse(file):
+            if element.tag == f"{NAMESPACE}si":
+                # Rich text runs are split over several <t> elements
+                strings.append("".join(text.text or "" for text in element.iter(f"{NAMESPACE}t")))
+                element.clear()
+    return strings
+
+
+def sheet_paths(workbook: ZipFile) -> dict[str, str]:
+    """
+    Maps sheet names to their part names, in workbook order.
+    """
+    with workbook.open("xl/_rels/workbook.xml.rels") as file:
+        targets = {
+            element.get("Id"): element.get("Target")
+            for _, element in iterparse(file)
+            if element.tag.endswith("Relationship")
+        }
+
+    sheets = {}
+    with workbook.open("xl/workbook.xml") as file:
+        for _, element in iterparse(file):
+            if element.tag == f"{NAMESPACE}sheet":
+                target = targets[element.get(f"{RELATIONSHIP_NAMESPACE}id")]
+                sheets[element.get("name")] = target.lstrip("/") if target.startswith("/") else f"xl/{target}"
+    return sheets
+
+
+def cell_value(cell, strings: list[str]) -> None | str | float | bool:
+    cell_type = cell.get("t", "n")
+    if cell_type == "inlineStr":
+        return "".join(text.text or "" for text in cell.iter(f"{NAMESPACE}t"))
+
+    value = cell.find(f"{NAMESPACE}v")
+    if value is None or value.text is None:
+        return None
+    if cell_type == "s":
+        return strings[int(value.text)]
+    if cell_type == "b":
+        return value.text == "1"
+    if cell_type in ("str", "e"):
+        return value.text
+    number = float(value.text)
+    return int(number) if number.is_integer() else number
+
+
+def read_sheet(data: bytes, sheet: None | str = None) -> list[list]:
+    """
+    Rows of the named sheet, or of the first one, as lists of cell values.
+    Gaps left by empty cells are filled with None.
+    """
+    with ZipFile(BytesIO(data)) as workbook:
+        strings = shared_strings(workbook)
+        sheets = sheet_paths(workbook)
+        part_name = sheets[sheet] if sheet else next(iter(sheets.values()))
+
+        rows = []
+        with workbook.open(part_name) as file:
+            for _, element in iterparse(file):
+                if element.tag != f"{NAMESPACE}row":
+                    continue
+                row = []
+                for cell in element.iter(f"{NAMESPACE}c"):
+                    reference = cell.get("r")
+                    if reference:
+                        row.extend([None] * (column_index(reference) - len(row)))
+                    row.append(cell_value(cell, strings))
+                rows.append(row)
+                element.clear()
+    return rows